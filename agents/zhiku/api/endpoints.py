@@ -1,38 +1,316 @@
 """
 API 端点 - 使用 Java 标准消息协议
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-import json
+from pydantic import BaseModel, TypeAdapter, ValidationError
 import asyncio
+from typing import Any, Callable, Dict, List
+import orjson
 
 from shared.protocols.java_protocol import (
     build_plan_declared,
     build_plan_change_status,
     build_stream_thing,
-    build_stream_content,
     build_invocation_declared,
     build_invocation_complete,
     build_artifact,
     build_artifact_change,
     build_end,
+    encode_message,
     StageStatus,
     InvocationType,
     generate_invocation_id,
     format_retrieval_result
 )
-from agents.zhiku.llm.dual_agent_orchestrator import DualAgentOrchestrator
+from config.settings import get_settings
+from shared.utils.async_utils import buffered
 from shared.utils.logger import setup_logger
 
 logger = setup_logger("v2_endpoints")
 
-# 初始化三智能体协调器
-orchestrator = DualAgentOrchestrator()
+# 三智能体协调器(首次请求时再导入并初始化,避免模块加载时引入各智能体及 LLM SDK)
+_orchestrator = None
+
+
+def _get_orchestrator():
+    """
+    获取全局协调器实例（单例模式，延迟初始化）
+    
+    Returns:
+        DualAgentOrchestrator: 协调器对象
+    """
+    global _orchestrator
+    
+    if _orchestrator is None:
+        from agents.zhiku.llm.dual_agent_orchestrator import DualAgentOrchestrator
+        _orchestrator = DualAgentOrchestrator()
+    
+    return _orchestrator
 
 router = APIRouter()
 
 
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+
+
+def _sse(msg) -> bytes:
+    """
+    编码 SSE 数据帧
+
+    Args:
+        msg: Java 标准格式消息
+
+    Returns:
+        bytes: SSE 数据帧（orjson 直接输出 UTF-8，无需 ensure_ascii；
+               join 一次性拼接，避免 + 连接产生的中间副本）
+    """
+    return b"".join((_SSE_PREFIX, encode_message(msg), _SSE_SUFFIX))
+
+
+def _chunks(text: str, size: int):
+    """
+    按固定长度切分文本,用于分块流式输出
+    
+    Args:
+        text: 待切分文本
+        size: 每块字符数
+        
+    Yields:
+        str: 文本块
+    """
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+# 静态帧:内容与请求无关,模块加载时预编码一次,请求中直接复用
+_STAGE_FRAMES = {
+    (stage_id, status): _sse(build_plan_change_status(stage_id, status))
+    for stage_id in ("planning", "retrieval", "summary")
+    for status in (StageStatus.RUNNING, StageStatus.COMPLETED)
+}
+_PLAN_DECLARED_FRAME = _sse(build_plan_declared())
+_END_FRAME = _sse(build_end())
+
+# 总结报告 ARTIFACT 声明(内容为空)
+_SUMMARY_DECLARED_FRAME = _sse(build_artifact(
+    stage_id="summary",
+    artifact_id="summary-content-001",
+    artifact_name="总结报告",
+    artifact_type="summary_report",
+    content="",  # 初始内容为空
+    source="知识库检索",
+    scope="STAGE",
+    data_type="FILE"  # 修改为 FILE
+))
+
+# 未检索到文档:声明总结报告并写入固定提示,总结阶段直接完成
+_NO_RESULTS_MESSAGE = "抱歉,没有找到相关文档。请尝试使用不同的关键词重新提问。"
+_NO_RESULTS_FRAMES = [
+    _SUMMARY_DECLARED_FRAME,
+    _sse(build_artifact_change(
+        stage_id="summary",
+        artifact_id="summary-content-001",
+        content=_NO_RESULTS_MESSAGE,
+        change_type="CONTENT_APPEND",
+        scope="STAGE",
+        data_type="FILE"
+    )),
+    _STAGE_FRAMES[("summary", StageStatus.COMPLETED)]
+]
+
+# 总结正文追加帧除 content 外固定不变:预编码 content 前后的字节,
+# 每个 token 只需序列化正文字符串本身,无需逐帧构建并序列化整条消息
+_CONTENT_PLACEHOLDER = "\x00content\x00"
+_SUMMARY_APPEND_PREFIX, _SUMMARY_APPEND_SUFFIX = _sse(build_artifact_change(
+    stage_id="summary",
+    artifact_id="summary-content-001",
+    content=_CONTENT_PLACEHOLDER,
+    change_type="CONTENT_APPEND",
+    scope="STAGE",
+    data_type="FILE"  # 修改为 FILE
+)).split(orjson.dumps(_CONTENT_PLACEHOLDER))
+
+
+# ============================================================
+# 协调器事件 -> SSE 帧 处理器
+# ============================================================
+
+class _StreamState:
+    """单个请求的事件流状态"""
+    
+    def __init__(self):
+        self.summary_started = False  # 是否已发送总结 ARTIFACT 声明
+        self.invocation_ids: Dict[tuple, str] = {}  # (kb_name, query, task_id) -> invocation_id, query_end 复用 query_start 的结果
+
+
+def _on_planning_start(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """规划阶段开始"""
+    return [_STAGE_FRAMES[("planning", StageStatus.RUNNING)]]
+
+
+def _on_planning_end(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """规划完成:发送分析结果,规划阶段完成"""
+    plan = event.get("plan", {})
+    analysis = plan.get("analysis", "")
+    return [
+        _sse(build_stream_thing(f"分析完成: {analysis}")),
+        _STAGE_FRAMES[("planning", StageStatus.COMPLETED)]
+    ]
+
+
+def _on_retrieval_start(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """检索阶段开始"""
+    return [_STAGE_FRAMES[("retrieval", StageStatus.RUNNING)]]
+
+
+def _on_query_start(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """单个查询开始:声明调用"""
+    kb_name = event.get("kb_name", "")
+    query_text = event.get("query", "")
+    
+    # 生成确定性的 invocation_id（使用 task_id 确保唯一性）
+    key = (kb_name, query_text, event.get("task_id", ""))
+    invocation_id = state.invocation_ids[key] = generate_invocation_id(*key)
+    
+    msg = build_invocation_declared(
+        stage_id="retrieval",
+        invocation_id=invocation_id,
+        name=f"正在查询{kb_name}: {query_text[:30]}...",
+        invocation_type=InvocationType.SEARCH
+    )
+    return [_sse(msg)]
+
+
+def _on_query_end(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """单个查询完成:调用完成并附带结果"""
+    success = event.get("success", False)
+    doc_metadata = event.get("doc_metadata", [])
+    
+    # 复用 query_start 生成的 invocation_id（缺失时按相同参数重新生成，结果一致）
+    key = (event.get("kb_name", ""), event.get("query", ""), event.get("task_id", ""))
+    invocation_id = state.invocation_ids.pop(key, None) or generate_invocation_id(*key)
+    
+    # 结果内容以 dict 传入，由协议构建器序列化为 JSON 字符串（协议约定 content 为字符串）
+    if success and doc_metadata:
+        content = {
+            "success": True,
+            "doc_count": event.get("doc_count", 0),
+            "documents": doc_metadata
+        }
+    elif success:
+        # 成功但没有文档
+        content = {
+            "success": True,
+            "doc_count": 0,
+            "message": "未检索到相关文档"
+        }
+    else:
+        # 失败
+        content = {
+            "success": False,
+            "error": event.get("error", "Unknown")
+        }
+    
+    msg = build_invocation_complete(
+        stage_id="retrieval",
+        invocation_id=invocation_id,
+        content=content
+    )
+    return [_sse(msg)]
+
+
+def _on_retrieval_end(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """检索阶段完成"""
+    total = event.get("total", 0)
+    return [
+        _sse(build_stream_thing(f"检索完成，共找到 {total} 个文档，准备生成总结...")),
+        _STAGE_FRAMES[("retrieval", StageStatus.COMPLETED)]
+    ]
+
+
+def _on_references(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """参考文献（在总结前）:先声明 ARTIFACT,再追加内容,然后总结阶段开始"""
+    # 参考文献（列表由协议构建器序列化为 JSON 字符串）
+    references = event.get("references", [])
+    
+    # 1. 先发送参考文献 ARTIFACT 声明（内容为空）
+    declared = build_artifact(
+        stage_id="summary",
+        artifact_id="references-001",
+        artifact_name="参考文献",
+        artifact_type="reference_list",
+        content="",  # 初始内容为空
+        source="知识库检索",
+        scope="STAGE",
+        data_type="STRUCTURED"
+    )
+    
+    # 2. 再发送 ARTIFACT_CHANGE 包含实际内容
+    change = build_artifact_change(
+        stage_id="summary",
+        artifact_id="references-001",
+        content=references,
+        change_type="CONTENT_APPEND",
+        artifact_name="参考文献",
+        artifact_type="reference_list",
+        source="知识库检索",
+        scope="STAGE",
+        data_type="STRUCTURED"
+    )
+    
+    # 3. 发送总结阶段开始状态
+    return [_sse(declared), _sse(change), _STAGE_FRAMES[("summary", StageStatus.RUNNING)]]
+
+
+def _on_content(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """总结正文片段:使用 ARTIFACT_CHANGE 流式输出"""
+    frames = []
+    
+    # 第一个 content 事件时，发送 ARTIFACT 声明
+    if not state.summary_started:
+        frames.append(_SUMMARY_DECLARED_FRAME)
+        state.summary_started = True
+    
+    frames.append(b"".join((_SUMMARY_APPEND_PREFIX, orjson.dumps(event["content"]), _SUMMARY_APPEND_SUFFIX)))
+    return frames
+
+
+def _on_summary_complete(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """总结完成:正文已通过 content 事件流式输出，这里只标记阶段完成"""
+    return [_STAGE_FRAMES[("summary", StageStatus.COMPLETED)]]
+
+
+def _on_no_results(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """未检索到文档:直接发送预编码的提示帧"""
+    return _NO_RESULTS_FRAMES
+
+
+def _on_error(event: Dict[str, Any], state: _StreamState) -> List[bytes]:
+    """错误处理"""
+    error_msg = event.get("error", "Unknown error")
+    logger.error(f"处理过程出错: {error_msg}")
+    return [_sse(build_stream_thing(f"❌ 错误: {error_msg}"))]
+
+
+# 事件类型 -> 处理器(返回待发送的 SSE 帧列表),查表分发代替 if/elif 链
+_EVENT_HANDLERS: Dict[str, Callable[[Dict[str, Any], _StreamState], List[bytes]]] = {
+    "planning_start": _on_planning_start,
+    "planning_end": _on_planning_end,
+    "retrieval_start": _on_retrieval_start,
+    "query_start": _on_query_start,
+    "query_end": _on_query_end,
+    "retrieval_end": _on_retrieval_end,
+    "references": _on_references,
+    "content": _on_content,
+    "summary_complete": _on_summary_complete,
+    "no_results": _on_no_results,
+    "error": _on_error,
+}
+
+
 class QueryRequest(BaseModel):
     """查询请求模型"""
     query: str
@@ -45,8 +323,21 @@ class QueryRequest(BaseModel):
         }
 
 
-@router.post("/api/v2/query")
-async def query_with_tools(request: QueryRequest):
+# 模块加载时构建一次校验器,请求中直接从原始 JSON 字节校验(跳过 dict 中间步骤)
+_QUERY_ADAPTER = TypeAdapter(QueryRequest)
+
+
+@router.post(
+    "/api/v2/query",
+    # 请求体由接口内部解析,这里显式声明 schema 以保留 OpenAPI 文档
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": QueryRequest.model_json_schema()}},
+            "required": True
+        }
+    }
+)
+async def query_with_tools(raw_request: Request):
     """
     查询接口（v2 - Java 标准协议）
     
@@ -56,240 +347,75 @@ async def query_with_tools(request: QueryRequest):
     - STREAM_THING: 思考过程
     - INVOCATION_DECLARED: 查询开始
     - INVOCATION_CHANGE: 查询完成
-    - STREAM_CONTENT: 正文流式输出
-    - ARTIFACT: 参考文献
+    - ARTIFACT_DECLARED / ARTIFACT_CHANGE: 参考文献、总结正文（流式追加）
     - END: 结束
     """
+    try:
+        request = _QUERY_ADAPTER.validate_json(await raw_request.body())
+    except ValidationError as e:
+        # 与 FastAPI 自动校验保持一致,返回 422(错误位置同样以 "body" 开头)
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])} for error in e.errors()
+        ])
+    
     if not request.query or not request.query.strip():
         raise HTTPException(status_code=400, detail="查询内容不能为空")
     
     logger.info(f"[v2] 收到查询请求: {request.query}")
 
+    settings = get_settings()
+    chunk_size = settings.stream_chunk_size
+    chunk_delay = settings.stream_chunk_delay
+
     async def generate_events(query: str):
         """生成 SSE 事件流"""
+        events = None
         try:
-
+            # 立即启动协调器并预取事件:规划请求与下方的 think 动画并行,
+            # 编码/写出当前事件时,协调器也可继续产出后续事件
+            # (首个请求在此初始化协调器,失败时同样返回错误帧与结束帧)
+            events = buffered(_get_orchestrator().process(query), maxsize=8)
+            
             # ========== 0. 模拟think ==========
             txt = "正在分析用户问题并制定检索计划..."
-            for txti in txt:
-                await asyncio.sleep(0.05)  # 使用异步 sleep，50ms 延迟
-                msg = build_stream_thing(txti)
-                yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
+            if chunk_delay > 0:
+                # 按块输出(而非逐字符),每块只注册一次定时器,减少帧数与序列化次数
+                for chunk in _chunks(txt, chunk_size):
+                    await asyncio.sleep(chunk_delay)
+                    yield _sse(build_stream_thing(chunk))
+            else:
+                # 不需要服务端控制节奏(由前端实现打字效果):整段一帧发出,不注册定时器
+                yield _sse(build_stream_thing(txt))
             # ========== 1. 声明所有阶段 ==========
-            msg = build_plan_declared()
-            yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
+            yield _PLAN_DECLARED_FRAME
             
             # ========== 2. 调用三智能体协调器 ==========
-            async for event in orchestrator.process(query):
-                event_type = event.get("type")
-                
-                # ========== 规划阶段 ==========
-                if event_type == "planning_start":
-                    # 规划阶段开始
-                    msg = build_plan_change_status("planning", StageStatus.RUNNING)
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                    
-
-                
-                elif event_type == "planning_end":
-                    # 规划完成
-                    plan = event.get("plan", {})
-                    analysis = plan.get("analysis", "")
-                    
-                    # 可选：发送分析结果
-                    msg = build_stream_thing(f"分析完成: {analysis}")
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                    
-                    # 规划阶段完成
-                    msg = build_plan_change_status("planning", StageStatus.COMPLETED)
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                
-                # ========== 检索阶段 ==========
-                elif event_type == "retrieval_start":
-                    # 检索阶段开始
-                    msg = build_plan_change_status("retrieval", StageStatus.RUNNING)
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                
-                elif event_type == "query_start":
-                    # 单个查询开始
-                    task_id = event.get("task_id", "")
-                    kb_name = event.get("kb_name", "")
-                    query_text = event.get("query", "")
-                    
-                    # 生成确定性的 invocation_id（使用 task_id 确保唯一性）
-                    invocation_id = generate_invocation_id(kb_name, query_text, task_id)
-                    
-                    # 声明调用
-                    msg = build_invocation_declared(
-                        stage_id="retrieval",
-                        invocation_id=invocation_id,
-                        name=f"正在查询{kb_name}: {query_text[:30]}...",
-                        invocation_type=InvocationType.SEARCH
-                    )
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                
-                elif event_type == "query_end":
-                    # 单个查询完成
-                    task_id = event.get("task_id", "")
-                    kb_name = event.get("kb_name", "")
-                    query_text = event.get("query", "")
-                    success = event.get("success", False)
-                    doc_count = event.get("doc_count", 0)
-                    doc_metadata = event.get("doc_metadata", [])
-                    
-                    # 使用相同的参数生成 invocation_id（确保与 query_start 一致）
-                    invocation_id = generate_invocation_id(kb_name, query_text, task_id)
-                    
-                    # 格式化结果内容为 JSON
-                    if success and doc_metadata:
-                        # 将文档元数据转换为 JSON 字符串
-                        content = json.dumps({
-                            "success": True,
-                            "doc_count": doc_count,
-                            "documents": doc_metadata
-                        }, ensure_ascii=False)
-                    elif success:
-                        # 成功但没有文档
-                        content = json.dumps({
-                            "success": True,
-                            "doc_count": 0,
-                            "message": "未检索到相关文档"
-                        }, ensure_ascii=False)
-                    else:
-                        # 失败
-                        error = event.get("error", "Unknown")
-                        content = json.dumps({
-                            "success": False,
-                            "error": error
-                        }, ensure_ascii=False)
-                    
-                    # 调用完成
-                    msg = build_invocation_complete(
-                        stage_id="retrieval",
-                        invocation_id=invocation_id,
-                        content=content
-                    )
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                
-                elif event_type == "retrieval_end":
-                    # 检索阶段完成
-                    total = event.get("total", 0)
-                    
-                    # 可选：发送总结信息
-                    msg = build_stream_thing(f"检索完成，共找到 {total} 个文档，准备生成总结...")
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                    
-                    # 检索阶段完成
-                    msg = build_plan_change_status("retrieval", StageStatus.COMPLETED)
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                
-                
-                # ========== 参考文献（在总结前） ==========
-                elif event_type == "references":
-                    # 参考文献
-                    references = event.get("references", [])
-                    
-                    # 转换为 JSON 字符串
-                    content = json.dumps(references, ensure_ascii=False)
-                    
-                    # 1. 先发送参考文献 ARTIFACT 声明（内容为空）
-                    msg = build_artifact(
-                        stage_id="summary",
-                        artifact_id="references-001",
-                        artifact_name="参考文献",
-                        artifact_type="reference_list",
-                        content="",  # 初始内容为空
-                        source="知识库检索",
-                        scope="STAGE",
-                        data_type="STRUCTURED"
-                    )
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                    
-                    # 2. 再发送 ARTIFACT_CHANGE 包含实际内容
-                    msg = build_artifact_change(
-                        stage_id="summary",
-                        artifact_id="references-001",
-                        content=content,
-                        change_type="CONTENT_APPEND",
-                        artifact_name="参考文献",
-                        artifact_type="reference_list",
-                        source="知识库检索",
-                        scope="STAGE",
-                        data_type="STRUCTURED"
-                    )
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                    
-                    # 3. 发送总结阶段开始状态
-                    msg = build_plan_change_status("summary", StageStatus.RUNNING)
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                
-                # ========== 总结阶段 ==========
-                elif event_type == "content":
-                    # 第一个 content 事件时，发送 ARTIFACT 声明
-                    if not hasattr(generate_events, "_summary_started"):
-                        # 发送 ARTIFACT 声明
-                        msg = build_artifact(
-                            stage_id="summary",
-                            artifact_id="summary-content-001",
-                            artifact_name="总结报告",
-                            artifact_type="summary_report",
-                            content="",  # 初始内容为空
-                            source="知识库检索",
-                            scope="STAGE",
-                            data_type="FILE"  # 修改为 FILE
-                        )
-                        yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                        generate_events._summary_started = True
-                    
-                    # 流式输出正文 - 使用 ARTIFACT_CHANGE
-                    msg = build_artifact_change(
-                        stage_id="summary",
-                        artifact_id="summary-content-001",
-                        content=event["content"],
-                        change_type="CONTENT_APPEND",
-                        scope="STAGE",
-                        data_type="FILE"  # 修改为 FILE
-                    )
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                
-                
-                # ========== 总结完成 ==========
-                elif event_type == "summary_complete":
-                    # 发送假的总结性正文（流式）
-                    summary_text = "综上所述，基于以上检索结果和分析，我们可以得出结论：1. XXXX; 2. XXXXX。"
-                    for char in summary_text:
-                        await asyncio.sleep(0.03)  # 30ms 延迟
-                        msg = build_stream_content(char)
-                        yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                    
-                    # 总结阶段完成
-                    msg = build_plan_change_status("summary", StageStatus.COMPLETED)
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-
-                
-                elif event_type == "error":
-                    # 错误处理
-                    error_msg = event.get("error", "Unknown error")
-                    logger.error(f"处理过程出错: {error_msg}")
-                    
-                    # 发送错误信息
-                    msg = build_stream_thing(f"❌ 错误: {error_msg}")
-                    yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
+            # 按事件类型查表分发,未知事件直接忽略
+            state = _StreamState()
+            async for event in events:
+                handler = _EVENT_HANDLERS.get(event.get("type"))
+                if handler is None:
+                    continue
+                for frame in handler(event, state):
+                    yield frame
             
             # ========== 3. 发送结束消息 ==========
-            end_msg = build_end()
-            yield f"data: {json.dumps(end_msg, ensure_ascii=False)}\n\n"
+            yield _END_FRAME
         
         except Exception as e:
             logger.error(f"事件生成出错: {e}", exc_info=True)
             
             # 发送错误消息
             error_msg = build_stream_thing(f"系统错误: {str(e)}")
-            yield f"data: {json.dumps(error_msg, ensure_ascii=False)}\n\n"
+            yield _sse(error_msg)
             
             # 发送结束消息
-            end_msg = build_end()
-            yield f"data: {json.dumps(end_msg, ensure_ascii=False)}\n\n"
+            yield _END_FRAME
+        
+        finally:
+            # 客户端断开或出错时取消预取任务
+            if events is not None:
+                await events.aclose()
     
     
     return StreamingResponse(
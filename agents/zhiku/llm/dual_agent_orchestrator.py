@@ -3,10 +3,12 @@
 协调规划智能体、检索智能体和总结智能体的工作流程
 """
 from typing import AsyncGenerator, Dict, Any
+import asyncio
 
 from agents.zhiku.llm.planning_agent import PlanningAgent
 from agents.zhiku.llm.retrieval_agent import RetrievalAgent
-from agents.zhiku.llm.summary_agent import SummaryAgent
+from agents.zhiku.llm.summary_agent import get_summary_agent
+from agents.zhiku.tools.knowledge_retrieval import clear_retrieval_cache, reset_kb_names
 from config.settings import get_settings
 from shared.utils.logger import setup_logger
 
@@ -15,6 +17,8 @@ logger = setup_logger("triple_agent_orchestrator")
 # 配置: 送入总结和返回参考文献的最大文档数
 MAX_DOCS_FOR_SUMMARY = 5  # 可根据需要调整
 
+# 配置: 每个知识库最多执行的查询数
+MAX_QUERIES_PER_KB = 3
 
 class DualAgentOrchestrator:
     """
@@ -30,10 +34,24 @@ class DualAgentOrchestrator:
     def __init__(self):
         self.planning_agent = PlanningAgent()
         self.retrieval_agent = RetrievalAgent()
-        self.summary_agent = SummaryAgent()
+        self.summary_agent = get_summary_agent()
+        
+        # 知识库配置在运行期基本不变,初始化时加载一次,避免每个请求重复解析
+        self._knowledge_bases = get_settings().get_knowledge_bases()
         
         logger.info("🎯 三智能体协调器初始化完成")
     
+    def invalidate(self):
+        """
+        重新加载知识库配置,并丢弃检索工具的知识库名称映射与检索结果缓存
+        
+        知识库配置(环境变量或 knowledge_bases.json)或知识库内容在运行期变更后调用
+        """
+        self._knowledge_bases = get_settings().get_knowledge_bases(reload=True)
+        reset_kb_names()
+        clear_retrieval_cache()
+        logger.info(f"知识库配置已重新加载: {[kb.name for kb in self._knowledge_bases]}")
+    
     async def process(
         self,
         user_query: str
@@ -54,6 +72,7 @@ class DualAgentOrchestrator:
                 - {"type": "tool_call_end", ...}
                 - {"type": "retrieval_end", "total": N}
                 - {"type": "content", "content": "..."}
+                - {"type": "no_results"} (未检索到文档,提示语由接口层发送)
                 - {"type": "references", "references": [...]}
                 - {"type": "error", "error": "..."}
         """
@@ -61,6 +80,8 @@ class DualAgentOrchestrator:
         logger.info(f"🚀 开始处理查询: {user_query}")
         logger.info("=" * 60)
         
+        speculative: Dict[str, Dict[str, asyncio.Task]] = {}  # kb_id -> {query: 提前发起的检索任务}
+        
         try:
             # ========================================
             # 阶段0: 规划智能体工作
@@ -68,13 +89,46 @@ class DualAgentOrchestrator:
             logger.info("📍 阶段0: 制定检索计划")
             yield {"type": "planning_start"}
             
-            # 获取知识库配置
-            settings = get_settings()
-            knowledge_bases = settings.get_knowledge_bases()
+            # 获取知识库配置(初始化时已缓存)
+            knowledge_bases = self._knowledge_bases
             logger.info(f"可用知识库: {[kb.name for kb in knowledge_bases]}")
             
-            # 调用规划智能体
-            plan = await self.planning_agent.plan(user_query, knowledge_bases)
+            retrieve = self.retrieval_agent.tool_functions["retrieve_knowledge"]
+            known_kb_ids = {kb.id for kb in knowledge_bases}
+            
+            def start_retrieval(kb_id: str, query: str):
+                """
+                提前发起一次检索(同一知识库的相同查询只发起一次)
+                
+                每个知识库累计最多 MAX_QUERIES_PER_KB 个,跨计划项生效
+                (计划可能把同一知识库拆成多项,合并后同样只执行这么多查询)
+                """
+                kb_tasks = speculative.setdefault(kb_id, {})
+                if query not in kb_tasks and len(kb_tasks) < MAX_QUERIES_PER_KB:
+                    kb_tasks[query] = asyncio.create_task(
+                        retrieve(query=query, top_k=5, knowledge_base_id=kb_id)
+                    )
+            
+            def on_plan_item(item: Dict[str, Any]):
+                """规划流式输出中某个知识库的计划已完整:立即发起其查询"""
+                kb_id = item.get("knowledge_base_id")
+                queries = item.get("queries")
+                if kb_id not in known_kb_ids or not isinstance(queries, list):
+                    return
+                for query in queries:
+                    if isinstance(query, str):
+                        start_retrieval(kb_id, query)
+            
+            def on_llm_start():
+                """规划需要一次 LLM 往返:同时用原始问题预检索各知识库,隐藏规划延迟
+                (规划失败时的降级计划即使用原始问题;计划未采用的预检索会被取消)"""
+                for kb in knowledge_bases:
+                    start_retrieval(kb.id, user_query)
+            
+            # 调用规划智能体(流式规划中已生成的查询会提前执行)
+            plan = await self.planning_agent.plan(
+                user_query, knowledge_bases, on_plan_item=on_plan_item, on_llm_start=on_llm_start
+            )
             
             # 通知规划完成
             yield {
@@ -94,7 +148,10 @@ class DualAgentOrchestrator:
             doc_manager = None
             retrieval_plan = plan.get("retrieval_plan", [])
             
-            async for event in self.retrieval_agent.retrieve_with_plan_parallel(retrieval_plan):
+            # 计划中的查询复用已发起的检索,其余预检索由检索智能体取消
+            async for event in self.retrieval_agent.retrieve_with_plan_parallel(
+                retrieval_plan, max_queries_per_kb=MAX_QUERIES_PER_KB, prefetched=speculative
+            ):
                 event_type = event.get("type")
                 
                 if event_type in ["kb_start", "query_start", "query_end", "kb_end"]:
@@ -122,12 +179,9 @@ class DualAgentOrchestrator:
                 "total": doc_count
             }
             
-            # 如果没有文档,提前结束
+            # 如果没有文档,提前结束(提示内容固定,由接口层发送预编码的帧)
             if doc_count == 0:
-                yield {
-                    "type": "content",
-                    "content": "抱歉,没有找到相关文档。请尝试使用不同的关键词重新提问。"
-                }
+                yield {"type": "no_results"}
                 return
             
             # ========================================
@@ -135,8 +189,8 @@ class DualAgentOrchestrator:
             # ========================================
             logger.info("📍 统一文档处理: 排序和准备参考文献")
             
-            # 1. 对文档按相似度排序
-            doc_manager.sort_documents(key="score", reverse=True)
+            # 1. 对文档按相似度排序(只用到前N个,部分排序即可)
+            doc_manager.sort_documents(key="score", reverse=True, top_k=MAX_DOCS_FOR_SUMMARY)
             logger.info(f"✅ 文档已按分数排序")
             
             # 2. 提前生成参考文献(这会按doc_id分组)
@@ -177,4 +231,10 @@ class DualAgentOrchestrator:
                 "type": "error",
                 "error": str(e)
             }
+        
+        finally:
+            # 出错或客户端断开时,取消仍在进行的预检索
+            for kb_tasks in speculative.values():
+                for task in kb_tasks.values():
+                    task.cancel()
 
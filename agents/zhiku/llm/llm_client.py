@@ -0,0 +1,124 @@
+"""
+DeepSeek 客户端模块
+各智能体共享同一个 AsyncOpenAI 客户端(同一个连接池),并用全局信号量限制并发调用数
+"""
+import asyncio
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+from config.settings import get_settings
+from shared.utils.logger import setup_logger
+
+logger = setup_logger("llm_client")
+
+# 配置: 连接池预热请求的超时(秒),预热不重试
+WARMUP_TIMEOUT = 5.0
+
+# 全局共享实例
+_client: Optional[AsyncOpenAI] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def http2_available() -> bool:
+    """
+    检查 HTTP/2 依赖(h2)是否可用
+    
+    Returns:
+        bool: 可用时启用 HTTP/2,多个并发请求复用同一 TCP 连接
+    """
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_llm_client() -> AsyncOpenAI:
+    """
+    获取全局 DeepSeek 客户端（单例模式）
+    
+    所有智能体共用一个连接池,避免每个实例各自建池导致连接无法复用、
+    高并发下出现连接池等待超时
+    
+    Returns:
+        AsyncOpenAI: 客户端对象
+    """
+    global _client
+    
+    if _client is None:
+        settings = get_settings()
+        
+        # 配置超时设置
+        timeout = httpx.Timeout(
+            connect=60.0,  # 连接超时: 60秒
+            read=300.0,    # 读取超时: 5分钟
+            write=300.0,   # 写入超时: 5分钟
+            pool=60.0      # 连接池超时: 60秒
+        )
+        
+        # 连接池大小与并发上限匹配
+        limits = httpx.Limits(
+            max_connections=settings.llm_max_concurrency,
+            max_keepalive_connections=settings.llm_max_concurrency,
+            keepalive_expiry=30.0  # 空闲连接保留 30 秒,避免请求间隙重复握手
+        )
+        
+        # HTTP/2: 并发请求在同一连接上多路复用,头部压缩
+        http2 = http2_available()
+        
+        _client = AsyncOpenAI(
+            api_key=settings.deepseek_api_key,
+            base_url=settings.deepseek_base_url,
+            http_client=httpx.AsyncClient(timeout=timeout, limits=limits, http2=http2),
+            max_retries=3  # 添加重试机制
+        )
+        logger.info(
+            f"DeepSeek 客户端初始化完成,最大并发: {settings.llm_max_concurrency}, "
+            f"HTTP/2: {'启用' if http2 else '未启用'}"
+        )
+    
+    return _client
+
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """
+    获取全局 LLM 调用信号量
+    
+    所有 chat.completions.create 调用都应在 async with 中执行,
+    使全进程同时在途的请求数不超过 LLM_MAX_CONCURRENCY(按 DeepSeek 限流配置)
+    
+    Returns:
+        asyncio.Semaphore: 信号量
+    """
+    global _semaphore
+    
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(get_settings().llm_max_concurrency)
+    
+    return _semaphore
+
+
+async def warmup():
+    """
+    预热 DeepSeek 连接池
+    
+    应用启动时发起一次轻量请求(GET /models),提前完成 DNS 解析与 TCP/TLS 握手,
+    首个用户请求无需再承担建连延迟。使用短超时且不重试(with_options 的副本共享同一连接池),
+    DeepSeek 不可达时快速放弃;失败不影响启动
+    """
+    try:
+        await get_llm_client().with_options(timeout=WARMUP_TIMEOUT, max_retries=0).models.list()
+        logger.info("DeepSeek 连接池预热完成")
+    except Exception as e:
+        logger.warning(f"DeepSeek 连接池预热失败(不影响服务): {e}")
+
+
+async def close_llm_client():
+    """关闭共享的 DeepSeek 客户端及其连接池(应用关闭时调用)"""
+    global _client
+    
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -1,16 +1,171 @@
 """
 规划智能体 - 负责分析问题并规划检索策略
 """
-from openai import AsyncOpenAI
-from typing import List, Dict, Any
+from functools import lru_cache
+from typing import List, Dict, Any, Callable, Optional, Tuple
+import copy
 import json
-import httpx
+import logging
 
 from config.settings import get_settings, KnowledgeBaseConfig
+from agents.zhiku.llm.llm_client import get_llm_client, get_llm_semaphore
 from shared.utils.logger import setup_logger
+from shared.utils.response_cache import TTLCache, normalize_query
 
 logger = setup_logger("planning_agent")
 
+# 配置: 规划缓存的最大条目数(LRU 淘汰)
+PLAN_CACHE_SIZE = 512
+
+# 配置: 规则规划要求命中的最少领域关键词数
+RULE_PLAN_MIN_HITS = 2
+
+# 配置: 规划输出的最大 token 数(规划 JSON 通常只有几百 token,限制生成长度以降低延迟)
+PLAN_MAX_TOKENS = 600
+
+# 规划提示词的固定部分。知识库列表放在最后,使长前缀在各请求间逐字节一致,
+# 便于 DeepSeek 服务端的前缀缓存命中
+_PLANNING_PROMPT_HEAD = """你是一个专业的检索规划助手。你的任务是分析用户问题,并制定最优的检索策略。
+
+**你的任务**:
+1. 分析用户问题的核心意图和关键概念
+2. 选择最相关的知识库(1-3个,避免全选)
+3. 为每个知识库生成2-3个优化的检索查询
+4. 输出JSON格式的检索计划
+
+**输出格式**:
+{
+    "analysis": "简要分析用户问题的核心意图",
+    "retrieval_plan": [
+        {
+            "knowledge_base_id": "知识库ID",
+            "knowledge_base_name": "知识库名称",
+            "queries": ["查询1", "查询2"],
+            "reason": "选择该知识库的理由"
+        }
+    ]
+}
+
+**重要原则**:
+- 只选择真正相关的知识库,不要全选
+- 每个查询应简洁明确,便于检索
+- 从不同角度设计查询,提高覆盖率
+- 如果问题跨领域,可以选择多个知识库
+
+**示例**:
+用户问题: "AI在金融风控中的应用和技术实现"
+输出:
+{
+    "analysis": "用户想了解AI在金融风控领域的应用案例和背后的技术实现方法",
+    "retrieval_plan": [
+        {
+            "knowledge_base_id": "kb_finance",
+            "knowledge_base_name": "金融研报库",
+            "queries": ["AI金融风控", "智能风险管理", "金融科技应用"],
+            "reason": "该库包含金融行业的AI应用案例和趋势分析"
+        },
+        {
+            "knowledge_base_id": "kb_tech",
+            "knowledge_base_name": "AI技术文档库",
+            "queries": ["机器学习风控", "异常检测算法", "深度学习金融"],
+            "reason": "该库包含AI技术实现细节和算法原理"
+        }
+    ]
+}
+
+**可用知识库**:
+"""
+_PLANNING_PROMPT_TAIL = "\n\n请直接输出JSON,不要包含其他内容。"
+
+
+@lru_cache(maxsize=32)
+def _build_system_prompt(kb_fields: Tuple[Tuple[str, str, str, str], ...]) -> str:
+    """
+    构建规划系统提示词
+    
+    Args:
+        kb_fields: 知识库字段元组 ((id, name, domain, description), ...)
+        
+    Returns:
+        str: 系统提示词
+    """
+    kb_info = "\n".join(
+        f"- **{name}** (ID: {kb_id})\n"
+        f"  领域: {domain}\n"
+        f"  描述: {description}"
+        for kb_id, name, domain, description in kb_fields
+    )
+    return _PLANNING_PROMPT_HEAD + kb_info + _PLANNING_PROMPT_TAIL
+
+
+class _PlanItemScanner:
+    """
+    流式规划结果扫描器
+    
+    逐段接收 LLM 输出的 JSON 文本,跟踪括号嵌套(忽略字符串内的括号),
+    每当 retrieval_plan 数组中的一个元素(顶层对象 -> 数组 -> 对象)闭合时,
+    立即解析并回调,无需等待完整响应
+    """
+    
+    def __init__(self, on_item: Callable[[Dict[str, Any]], None]):
+        self.on_item = on_item
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escaped = False
+        # 已接收的全部片段(结束时一次拼接),以及当前元素跨片段的已接收部分
+        self._parts: List[str] = []
+        self._item_parts: Optional[List[str]] = None
+    
+    def feed(self, text: str):
+        """
+        追加一段输出并扫描
+        
+        只扫描新增片段,不在每次调用时拼接完整文本
+        
+        Args:
+            text: 新增的文本片段
+        """
+        self._parts.append(text)
+        stack = self._stack
+        item_start = 0  # 当前元素在本片段中的起始位置(元素始于之前片段时为 0)
+        for i, ch in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                stack.append(ch)
+                if stack == ["{", "[", "{"]:
+                    self._item_parts = []
+                    item_start = i
+            elif ch in "}]":
+                if stack == ["{", "[", "{"] and ch == "}" and self._item_parts is not None:
+                    self._item_parts.append(text[item_start:i + 1])
+                    self._emit("".join(self._item_parts))
+                    self._item_parts = None
+                if stack:
+                    stack.pop()
+        # 元素尚未闭合:保留其在本片段中的部分
+        if self._item_parts is not None:
+            self._item_parts.append(text[item_start:])
+    
+    def _emit(self, item_text: str):
+        try:
+            item = json.loads(item_text)
+        except json.JSONDecodeError:
+            return
+        if isinstance(item, dict):
+            self.on_item(item)
+    
+    def getvalue(self) -> str:
+        """返回完整输出文本"""
+        return "".join(self._parts)
+
 
 class PlanningAgent:
     """
@@ -26,29 +181,68 @@ class PlanningAgent:
     def __init__(self):
         settings = get_settings()
         
-        # 配置超时设置
-        timeout = httpx.Timeout(
-            connect=60.0,  # 连接超时: 60秒
-            read=300.0,    # 读取超时: 5分钟
-            write=300.0,   # 写入超时: 5分钟
-            pool=60.0      # 连接池超时: 60秒
-        )
-        
-        # 初始化 DeepSeek 客户端
-        self.client = AsyncOpenAI(
-            api_key=settings.deepseek_api_key,
-            base_url=settings.deepseek_base_url,
-            timeout=timeout,
-            max_retries=3  # 添加重试机制
-        )
+        # 使用全局共享的 DeepSeek 客户端(共享连接池)
+        self.client = get_llm_client()
         self.model = settings.deepseek_model
         
+        # 规划缓存: (知识库签名, 归一化查询) -> 规划结果
+        # (规划只取决于问题与知识库配置,不设有效期,仅按 LRU 淘汰)
+        self._plan_cache = TTLCache(maxsize=PLAN_CACHE_SIZE, ttl=float("inf"))
+        
         logger.info(f"规划智能体初始化完成,模型: {self.model}")
     
+    @staticmethod
+    def _cache_key(
+        user_query: str,
+        knowledge_bases: List[KnowledgeBaseConfig]
+    ) -> Tuple[Tuple[str, ...], str]:
+        """
+        生成规划缓存键
+        
+        查询做大小写、空白和首尾标点归一化,仅表面形式不同的问题命中同一条缓存;
+        知识库 ID 集合纳入键中,知识库配置变化后旧缓存自然失效
+        
+        Args:
+            user_query: 用户问题
+            knowledge_bases: 可用的知识库列表
+            
+        Returns:
+            Tuple: (知识库签名, 归一化查询)
+        """
+        kb_signature = tuple(sorted(kb.id for kb in knowledge_bases))
+        return kb_signature, normalize_query(user_query)
+    
+    def _get_cached_plan(self, key: Tuple[Tuple[str, ...], str]) -> Optional[Dict[str, Any]]:
+        """
+        查询规划缓存(命中时刷新 LRU 顺序)
+        
+        Args:
+            key: 缓存键
+            
+        Returns:
+            Optional[Dict]: 规划结果副本,未命中返回 None
+        """
+        plan = self._plan_cache.get(key)
+        if plan is None:
+            return None
+        return copy.deepcopy(plan)
+    
+    def _put_cached_plan(self, key: Tuple[Tuple[str, ...], str], plan: Dict[str, Any]):
+        """
+        写入规划缓存(超过上限时淘汰最久未使用的条目)
+        
+        Args:
+            key: 缓存键
+            plan: 规划结果
+        """
+        self._plan_cache.put(key, copy.deepcopy(plan))
+    
     async def plan(
         self, 
         user_query: str, 
-        knowledge_bases: List[KnowledgeBaseConfig]
+        knowledge_bases: List[KnowledgeBaseConfig],
+        on_plan_item: Optional[Callable[[Dict[str, Any]], None]] = None,
+        on_llm_start: Optional[Callable[[], None]] = None
     ) -> Dict[str, Any]:
         """
         为用户查询生成检索计划
@@ -56,6 +250,10 @@ class PlanningAgent:
         Args:
             user_query: 用户问题
             knowledge_bases: 可用的知识库列表
+            on_plan_item: 可选回调,LLM 流式输出中每个 retrieval_plan 元素生成完毕时调用
+                          (调用方可据此提前发起检索;最终以返回的完整计划为准)
+            on_llm_start: 可选回调,确定需要调用 LLM 规划时(规则计划与缓存均未命中)调用,
+                          调用方可借此在规划往返期间做预检索等工作
             
         Returns:
             Dict: 检索计划,格式:
@@ -89,95 +287,65 @@ class PlanningAgent:
                 ]
             }
         
-        # 构建知识库描述
-        kb_descriptions = []
-        for kb in knowledge_bases:
-            kb_descriptions.append(
-                f"- **{kb.name}** (ID: {kb.id})\n"
-                f"  领域: {kb.domain}\n"
-                f"  描述: {kb.description}"
-            )
-        kb_info = "\n".join(kb_descriptions)
+        # 问题明确只属于一个知识库时,直接生成规则计划
+        rule_plan = self._try_rule_based_plan(user_query, knowledge_bases)
+        if rule_plan is not None:
+            return rule_plan
+        
+        # 命中规划缓存时跳过 LLM 调用
+        cache_key = self._cache_key(user_query, knowledge_bases)
+        cached_plan = self._get_cached_plan(cache_key)
+        if cached_plan is not None:
+            logger.info(f"✅ 规划缓存命中: {cache_key[1]}")
+            return cached_plan
+        
+        if on_llm_start is not None:
+            on_llm_start()
+        
+        # 构建系统提示词(相同知识库配置复用缓存结果)
+        system_prompt = _build_system_prompt(tuple(
+            (kb.id, kb.name, kb.domain, kb.description) for kb in knowledge_bases
+        ))
         
-        # 规划提示词
-        system_prompt = f"""你是一个专业的检索规划助手。你的任务是分析用户问题,并制定最优的检索策略。
-
-**可用知识库**:
-{kb_info}
-
-**你的任务**:
-1. 分析用户问题的核心意图和关键概念
-2. 选择最相关的知识库(1-3个,避免全选)
-3. 为每个知识库生成2-3个优化的检索查询
-4. 输出JSON格式的检索计划
-
-**输出格式**:
-{{
-    "analysis": "简要分析用户问题的核心意图",
-    "retrieval_plan": [
-        {{
-            "knowledge_base_id": "知识库ID",
-            "knowledge_base_name": "知识库名称",
-            "queries": ["查询1", "查询2"],
-            "reason": "选择该知识库的理由"
-        }}
-    ]
-}}
-
-**重要原则**:
-- 只选择真正相关的知识库,不要全选
-- 每个查询应简洁明确,便于检索
-- 从不同角度设计查询,提高覆盖率
-- 如果问题跨领域,可以选择多个知识库
-
-**示例**:
-用户问题: "AI在金融风控中的应用和技术实现"
-输出:
-{{
-    "analysis": "用户想了解AI在金融风控领域的应用案例和背后的技术实现方法",
-    "retrieval_plan": [
-        {{
-            "knowledge_base_id": "kb_finance",
-            "knowledge_base_name": "金融研报库",
-            "queries": ["AI金融风控", "智能风险管理", "金融科技应用"],
-            "reason": "该库包含金融行业的AI应用案例和趋势分析"
-        }},
-        {{
-            "knowledge_base_id": "kb_tech",
-            "knowledge_base_name": "AI技术文档库",
-            "queries": ["机器学习风控", "异常检测算法", "深度学习金融"],
-            "reason": "该库包含AI技术实现细节和算法原理"
-        }}
-    ]
-}}
-
-请直接输出JSON,不要包含其他内容。"""
-
         try:
-            # 调用 DeepSeek 生成规划
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"请为以下问题制定检索计划:\n{user_query}"}
-                ],
-                temperature=0.3,  # 降低温度,让规划更稳定
-                response_format={"type": "json_object"}  # 强制JSON输出
-            )
+            # 流式调用 DeepSeek 生成规划(受全局并发上限约束),
+            # 每个知识库的计划生成完毕即回调,不必等待完整响应
+            scanner = _PlanItemScanner(on_plan_item or (lambda item: None))
+            async with get_llm_semaphore():
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": f"请为以下问题制定检索计划:\n{user_query}"}
+                    ],
+                    temperature=0.3,  # 降低温度,让规划更稳定
+                    response_format={"type": "json_object"},  # 强制JSON输出
+                    max_tokens=PLAN_MAX_TOKENS,
+                    stream=True
+                )
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        scanner.feed(chunk.choices[0].delta.content)
             
             # 解析响应
-            content = response.choices[0].message.content
+            content = scanner.getvalue()
             plan = json.loads(content)
             
             logger.info(f"✅ 规划完成,选择了 {len(plan.get('retrieval_plan', []))} 个知识库")
-            logger.debug(f"规划详情: {json.dumps(plan, ensure_ascii=False, indent=2)}")
+            
+            # 仅缓存 LLM 成功生成的规划(降级方案不缓存)
+            self._put_cached_plan(cache_key, plan)
+            # 序列化整份规划开销不小,仅在 DEBUG 级别开启时执行
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("规划详情: %s", json.dumps(plan, ensure_ascii=False, indent=2))
             
             return plan
             
         except json.JSONDecodeError as e:
             logger.error(f"❌ 解析规划结果失败: {e}")
             logger.error(f"原始响应: {content}")
-            # 降级方案:使用所有知识库
+            # 降级方案:使用所有知识库(强制 JSON 输出下应很少出现,频繁出现时需排查,
+            # 如规划被 PLAN_MAX_TOKENS 截断)
             return self._fallback_plan(user_query, knowledge_bases)
         
         except Exception as e:
@@ -185,6 +353,45 @@ class PlanningAgent:
             # 降级方案:使用所有知识库
             return self._fallback_plan(user_query, knowledge_bases)
     
+    def _try_rule_based_plan(
+        self,
+        user_query: str,
+        knowledge_bases: List[KnowledgeBaseConfig]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        基于领域关键词的规则规划
+        
+        仅当恰好一个知识库命中至少 RULE_PLAN_MIN_HITS 个关键词、其他知识库均未命中时生效
+        
+        Args:
+            user_query: 用户问题
+            knowledge_bases: 知识库列表
+            
+        Returns:
+            Optional[Dict]: 检索计划(格式同 LLM 规划),无法确定时返回 None
+        """
+        scores = [
+            (kb, sum(1 for keyword in kb.domain_keywords if keyword in user_query))
+            for kb in knowledge_bases
+        ]
+        matched = [(kb, score) for kb, score in scores if score > 0]
+        if len(matched) != 1 or matched[0][1] < RULE_PLAN_MIN_HITS:
+            return None
+        
+        kb, score = matched[0]
+        logger.info(f"✅ 规则规划命中: {kb.name} (命中 {score} 个领域关键词)")
+        return {
+            "analysis": f"用户查询: {user_query}",
+            "retrieval_plan": [
+                {
+                    "knowledge_base_id": kb.id,
+                    "knowledge_base_name": kb.name,
+                    "queries": [user_query],  # 直接使用原始查询
+                    "reason": "领域关键词匹配"
+                }
+            ]
+        }
+    
     def _fallback_plan(
         self, 
         user_query: str, 
@@ -1,20 +1,47 @@
 """
 检索智能体 - 负责分析问题并执行多轮检索
 """
-from openai import AsyncOpenAI
-from typing import List, Dict, Any
-import json
+from typing import List, Dict, Any, Optional, Tuple
 import asyncio
-import uuid
-import httpx
+import secrets
+import orjson
 
 from config.settings import get_settings
-from agents.zhiku.tools.knowledge_retrieval import AVAILABLE_TOOLS, TOOL_FUNCTIONS
+from agents.zhiku.llm.llm_client import get_llm_client, get_llm_semaphore
+from agents.zhiku.tools.knowledge_retrieval import AVAILABLE_TOOLS, TOOL_FUNCTIONS, RetrieveKwargs
+from shared.utils.async_utils import merged
 from shared.utils.logger import setup_logger
 from shared.utils.document_manager import Document, DocumentManager
 
 logger = setup_logger("retrieval_agent")
 
+# 配置: 单个知识库内并发执行的最大查询数
+MAX_CONCURRENT_QUERIES = 5
+
+# 检索提示词(固定内容,模块加载时构建一次)
+_RETRIEVAL_SYSTEM_PROMPT = """你是一个专业的检索助手。你的任务是为用户问题找到最相关的文档。
+
+**核心任务**:
+- 分析用户问题,提取核心概念
+- **必须多次调用** retrieve_knowledge 工具,使用不同关键词
+- 建议调用 2-3 次,从不同角度检索
+
+**检索策略**:
+1. 第1次:使用问题的主要关键词
+2. 第2次:使用相关概念、同义词或英文术语
+3. 第3次:从细分领域或应用场景检索
+
+**示例**:
+用户问"人工智能在金融领域的应用"
+- 调用1: retrieve_knowledge(query="人工智能 金融应用", top_k=5)
+- 调用2: retrieve_knowledge(query="AI 银行 投资 风控", top_k=5)
+- 调用3: retrieve_knowledge(query="机器学习 量化交易", top_k=5)
+
+**重要**:
+- 每次使用不同的关键词组合
+- 不要重复检索相同的内容
+- 检索完成后,直接停止(不需要生成答案)"""
+
 
 class RetrievalAgent:
     """
@@ -31,27 +58,28 @@ class RetrievalAgent:
     def __init__(self):
         settings = get_settings()
         
-        # 配置超时设置
-        timeout = httpx.Timeout(
-            connect=60.0,  # 连接超时: 60秒
-            read=300.0,    # 读取超时: 5分钟
-            write=300.0,   # 写入超时: 5分钟
-            pool=60.0      # 连接池超时: 60秒
-        )
-        
-        # 初始化 DeepSeek 客户端
-        self.client = AsyncOpenAI(
-            api_key=settings.deepseek_api_key,
-            base_url=settings.deepseek_base_url,
-            timeout=timeout,
-            max_retries=3  # 添加重试机制
-        )
+        # 使用全局共享的 DeepSeek 客户端(共享连接池)
+        self.client = get_llm_client()
         self.model = settings.deepseek_model
         
         # 注册工具
         self.tools = AVAILABLE_TOOLS
         self.tool_functions = TOOL_FUNCTIONS
         
+        # 初始化时从工具 schema 提取各工具允许的参数名,调用时直接按此过滤
+        self.tool_params = {
+            tool["function"]["name"]: frozenset(tool["function"]["parameters"]["properties"])
+            for tool in self.tools
+        }
+        
+        # 每轮调用相同的请求参数(每次只需再传入 messages)
+        self._create_kwargs = {
+            "model": self.model,
+            "tools": self.tools,
+            "stream": False,  # 检索阶段不需要流式
+            "temperature": 0.3  # 降低温度,让检索更稳定
+        }
+        
         # 文档管理器
         self.doc_manager = DocumentManager()
         
@@ -73,32 +101,8 @@ class RetrievalAgent:
         """
         logger.info(f"🔍 检索智能体开始工作: {user_query}")
         
-        # 专门的检索提示词
-        system_prompt = """你是一个专业的检索助手。你的任务是为用户问题找到最相关的文档。
-
-**核心任务**:
-- 分析用户问题,提取核心概念
-- **必须多次调用** retrieve_knowledge 工具,使用不同关键词
-- 建议调用 2-3 次,从不同角度检索
-
-**检索策略**:
-1. 第1次:使用问题的主要关键词
-2. 第2次:使用相关概念、同义词或英文术语
-3. 第3次:从细分领域或应用场景检索
-
-**示例**:
-用户问"人工智能在金融领域的应用"
-- 调用1: retrieve_knowledge(query="人工智能 金融应用", top_k=5)
-- 调用2: retrieve_knowledge(query="AI 银行 投资 风控", top_k=5)
-- 调用3: retrieve_knowledge(query="机器学习 量化交易", top_k=5)
-
-**重要**:
-- 每次使用不同的关键词组合
-- 不要重复检索相同的内容
-- 检索完成后,直接停止(不需要生成答案)"""
-
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": _RETRIEVAL_SYSTEM_PROMPT},
             {"role": "user", "content": f"请为以下问题进行多角度检索:{user_query}"}
         ]
         
@@ -109,14 +113,12 @@ class RetrievalAgent:
             logger.info(f"📍 检索第 {iteration} 轮")
             
             try:
-                # 调用 DeepSeek
-                response = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    tools=self.tools,
-                    stream=False,  # 检索阶段不需要流式
-                    temperature=0.3  # 降低温度,让检索更稳定
-                )
+                # 调用 DeepSeek(受全局并发上限约束)
+                async with get_llm_semaphore():
+                    response = await self.client.chat.completions.create(
+                        messages=messages,
+                        **self._create_kwargs
+                    )
                 
                 choice = response.choices[0]
                 message = choice.message
@@ -143,12 +145,20 @@ class RetrievalAgent:
                     ]
                 })
                 
-                # 执行工具调用
+                # 解析本轮全部工具调用
+                calls = []
                 for tool_call in message.tool_calls:
                     function_name = tool_call.function.name
-                    arguments = json.loads(tool_call.function.arguments)
+                    raw_arguments = tool_call.function.arguments
+                    arguments = orjson.loads(raw_arguments)
                     
-                    logger.info(f"🔧 调用工具: {function_name}({json.dumps(arguments, ensure_ascii=False)})")
+                    # 只保留 schema 中声明的参数(模型偶尔会多生成字段,直接 ** 传入会报错)
+                    allowed_params = self.tool_params.get(function_name)
+                    if allowed_params is not None and not allowed_params.issuperset(arguments):
+                        arguments = {k: v for k, v in arguments.items() if k in allowed_params}
+                    
+                    # 直接记录原始参数字符串,无需再序列化一次
+                    logger.info(f"🔧 调用工具: {function_name}({raw_arguments})")
                     
                     # 通知前端:工具调用开始
                     yield {
@@ -156,32 +166,15 @@ class RetrievalAgent:
                         "tool": function_name,
                         "arguments": arguments
                     }
-                    
-                    # 执行工具
-                    if function_name in self.tool_functions:
-                        result = await self.tool_functions[function_name](**arguments)
-                        
-                        # 收集文档
-                        if result.get("success") and "results" in result:
-                            for item in result["results"]:
-                                doc = Document(
-                                    content=item.get("content", ""),
-                                    source=item.get("source", "Unknown"),
-                                    knowledge_id=item.get("chunk_id"),
-                                    metadata={
-                                        "score": item.get("score"),
-                                        "doc_id": item.get("doc_id"),
-                                        "doc_url": item.get("doc_url"),
-                                        "knowledge_base_id": item.get("knowledge_base_id"),
-                                        "knowledge_base_name": item.get("knowledge_base_name")
-                                    }
-                                )
-                                self.doc_manager.add_document(doc)
-                            
-                            logger.info(f"✅ 本次检索到 {len(result['results'])} 个文档,总计: {len(self.doc_manager.documents)}")
-                    else:
-                        result = {"success": False, "error": f"未知工具: {function_name}"}
-                    
+                    calls.append((tool_call.id, function_name, arguments))
+                
+                # 并发执行本轮全部工具调用(相互独立,无需逐个等待)
+                results = await asyncio.gather(*[
+                    self._invoke_tool(function_name, arguments)
+                    for _, function_name, arguments in calls
+                ])
+                
+                for (tool_call_id, function_name, _), result in zip(calls, results):
                     # 通知前端:工具调用结束
                     yield {
                         "type": "tool_call_end",
@@ -192,8 +185,8 @@ class RetrievalAgent:
                     # 添加工具结果到消息
                     messages.append({
                         "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": json.dumps(result, ensure_ascii=False)
+                        "tool_call_id": tool_call_id,
+                        "content": orjson.dumps(result).decode()  # orjson 默认不转义非 ASCII
                     })
                 
             except Exception as e:
@@ -208,10 +201,36 @@ class RetrievalAgent:
             "doc_manager": self.doc_manager
         }
     
+    async def _invoke_tool(self, function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        执行单个工具调用并收集检索到的文档
+        
+        Args:
+            function_name: 工具名称
+            arguments: 工具参数
+            
+        Returns:
+            Dict: 工具执行结果
+        """
+        if function_name not in self.tool_functions:
+            return {"success": False, "error": f"未知工具: {function_name}"}
+        
+        result = await self.tool_functions[function_name](**arguments)
+        
+        # 收集文档
+        if result.get("success") and "results" in result:
+            # 先构建全部文档,再批量加入文档管理器(一次去重、一次追加)
+            self.doc_manager.add_documents(Document.from_retrieval_items(result["results"]))
+            
+            logger.info(f"✅ 本次检索到 {len(result['results'])} 个文档,总计: {len(self.doc_manager.documents)}")
+        
+        return result
+    
     async def retrieve_with_plan_parallel(
         self, 
         retrieval_plan: List[Dict[str, Any]],
-        max_queries_per_kb: int = 3
+        max_queries_per_kb: int = 3,
+        prefetched: Optional[Dict[str, Dict[str, asyncio.Task]]] = None
     ):
         """
         根据规划执行并行多知识库检索
@@ -219,6 +238,8 @@ class RetrievalAgent:
         Args:
             retrieval_plan: 检索计划
             max_queries_per_kb: 每个知识库最大查询次数
+            prefetched: 已提前发起的检索任务 {kb_id: {query: Task}},
+                        计划中的查询直接使用其结果,不在计划中的任务会被取消
             
         Yields:
             Dict: 事件
@@ -230,37 +251,34 @@ class RetrievalAgent:
         """
         logger.info(f"🔍 检索智能体开始并行检索,共 {len(retrieval_plan)} 个知识库")
         
-        # 为每个知识库创建任务
-        async def collect_kb_events(task_id, kb_id, kb_name, queries):
-            """收集单个知识库的所有事件"""
-            events = []
-            async for event in self._retrieve_kb_async(task_id, kb_id, kb_name, queries):
-                events.append(event)
-            return events
-        
-        # 创建所有任务
-        all_tasks = []
-        for plan_item in retrieval_plan:
-            kb_id = plan_item["knowledge_base_id"]
-            kb_name = plan_item["knowledge_base_name"]
-            queries = plan_item["queries"][:max_queries_per_kb]
+        # 为每个知识库创建事件流(同一知识库的计划项先合并,重复的 (查询, 知识库) 只检索一次)
+        kb_streams = []
+        reused = set()  # 被计划采用的预检索任务
+        for kb_id, kb_name, queries in self._merge_plan(retrieval_plan, max_queries_per_kb):
+            # 只复用计划中查询的预检索结果,执行的查询以合并后的计划为准
+            kb_prefetched = prefetched.get(kb_id) if prefetched else None
+            if kb_prefetched:
+                kb_prefetched = {q: kb_prefetched[q] for q in queries if q in kb_prefetched}
+                reused.update(kb_prefetched.values())
             
-            # 生成唯一任务ID
-            task_id = str(uuid.uuid4())[:8]
+            # 生成唯一任务ID(8 位十六进制,与原先截取的 UUID 前缀格式一致)
+            task_id = secrets.token_hex(4)
             
-            # 创建任务(注意:这里是协程,不是生成器)
-            task = collect_kb_events(task_id, kb_id, kb_name, queries)
-            all_tasks.append(task)
+            kb_streams.append(self._retrieve_kb_async(task_id, kb_id, kb_name, queries, kb_prefetched))
+        
+        # 计划未采用的预检索(知识库未被选中,或查询不在计划中)直接取消,结果不并入文档集合
+        if prefetched:
+            for kb_tasks in prefetched.values():
+                for task in kb_tasks.values():
+                    if task not in reused:
+                        task.cancel()
         
         # 并行执行所有知识库的检索
-        logger.info(f"🚀 启动 {len(all_tasks)} 个并行检索任务")
+        logger.info(f"🚀 启动 {len(kb_streams)} 个并行检索任务")
         
-        # 使用 asyncio.as_completed 来实时获取完成的任务
-        for coro in asyncio.as_completed(all_tasks):
-            events = await coro
-            # 按顺序yield所有事件
-            for event in events:
-                yield event
+        # 合并各知识库的事件流:任一知识库产生事件即实时转发,不等该知识库全部完成
+        async for event in merged(kb_streams):
+            yield event
         
         logger.info(f"🎉 并行检索完成,共收集 {len(self.doc_manager.documents)} 个唯一文档")
         
@@ -270,12 +288,44 @@ class RetrievalAgent:
             "doc_manager": self.doc_manager
         }
     
+    @staticmethod
+    def _merge_plan(
+        retrieval_plan: List[Dict[str, Any]],
+        max_queries_per_kb: int
+    ) -> List[Tuple[str, str, List[str]]]:
+        """
+        合并检索计划中的重复项
+        
+        LLM 生成的计划可能把同一知识库拆成多项,或在同一知识库下重复某个查询,
+        合并后每个 (查询, 知识库) 组合只检索一次
+        
+        Args:
+            retrieval_plan: 检索计划
+            max_queries_per_kb: 每个知识库最大查询次数(去重后截取)
+            
+        Returns:
+            List[Tuple]: [(kb_id, kb_name, queries), ...],保持计划中的顺序
+        """
+        by_kb: Dict[str, Tuple[str, Dict[str, None]]] = {}
+        for plan_item in retrieval_plan:
+            kb_id = plan_item["knowledge_base_id"]
+            if kb_id not in by_kb:
+                by_kb[kb_id] = (plan_item["knowledge_base_name"], {})
+            # dict 保持插入顺序,用作有序去重集合
+            by_kb[kb_id][1].update(dict.fromkeys(plan_item["queries"]))
+        
+        return [
+            (kb_id, kb_name, list(queries)[:max_queries_per_kb])
+            for kb_id, (kb_name, queries) in by_kb.items()
+        ]
+    
     async def _retrieve_kb_async(
         self,
         task_id: str,
         kb_id: str,
         kb_name: str,
-        queries: List[str]
+        queries: List[str],
+        prefetched: Optional[Dict[str, asyncio.Task]] = None
     ):
         """
         异步检索单个知识库
@@ -285,6 +335,7 @@ class RetrievalAgent:
             kb_id: 知识库ID
             kb_name: 知识库名称
             queries: 查询列表
+            prefetched: 已提前发起的检索任务 {query: Task}
             
         Yields:
             Dict: 事件
@@ -301,61 +352,107 @@ class RetrievalAgent:
         }
         
         kb_doc_count = 0
+        # 限制单个知识库内同时进行的查询数
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
         
+        # 通知:查询开始(先声明全部查询,再并发执行)
         for query in queries:
-            logger.info(f"[{task_id}] 执行查询: {query}")
-            
-            # 通知:查询开始
             yield {
                 "type": "query_start",
                 "task_id": task_id,
                 "kb_name": kb_name,
                 "query": query
             }
+        
+        # 并发执行查询(受信号量限制),按完成顺序返回结果
+        tasks = [
+            asyncio.create_task(self._run_one_query(
+                task_id, kb_id, kb_name, query, semaphore,
+                prefetched.get(query) if prefetched else None
+            ))
+            for query in queries
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                event = await next_done
+                kb_doc_count += event["doc_count"]
+                yield event
+        finally:
+            # 消费者提前退出时取消尚未完成的查询
+            for task in tasks:
+                task.cancel()
+        
+        # 通知:知识库检索完成
+        logger.info(f"[{task_id}] ✅ 知识库 {kb_name} 检索完成,共 {kb_doc_count} 个文档")
+        yield {
+            "type": "kb_end",
+            "task_id": task_id,
+            "kb_id": kb_id,
+            "kb_name": kb_name,
+            "total_docs": kb_doc_count
+        }
+    
+    async def _run_one_query(
+        self,
+        task_id: str,
+        kb_id: str,
+        kb_name: str,
+        query: str,
+        semaphore: asyncio.Semaphore,
+        prefetched_task: Optional[asyncio.Task] = None
+    ) -> Dict[str, Any]:
+        """
+        执行单个查询并收集文档
+        
+        Args:
+            task_id: 任务ID
+            kb_id: 知识库ID
+            kb_name: 知识库名称
+            query: 查询内容
+            semaphore: 并发限制信号量(同一知识库的查询共享)
+            prefetched_task: 已提前发起的该查询的检索任务(可选)
+            
+        Returns:
+            Dict: query_end 事件(失败时 success 为 False 并附带 error)
+        """
+        async with semaphore:
+            logger.info(f"[{task_id}] 执行查询: {query}")
             
             try:
-                # 执行检索
-                arguments = {
-                    "query": query,
-                    "top_k": 5,
-                    "knowledge_base_id": kb_id
-                }
-                
-                result = await self.tool_functions["retrieve_knowledge"](**arguments)
+                # 已提前发起的检索直接等待其结果;否则按固定签名直接传参执行,
+                # 无需先构造参数字典再 ** 解包
+                if prefetched_task is not None:
+                    result = await prefetched_task
+                else:
+                    result = await self.tool_functions["retrieve_knowledge"](
+                        query=query, top_k=5, knowledge_base_id=kb_id
+                    )
                 
                 # 收集文档
                 doc_count = 0
                 doc_metadata = []  # 收集文档元数据
                 if result.get("success") and "results" in result:
-                    for item in result["results"]:
-                        doc = Document(
-                            content=item.get("content", ""),
-                            source=item.get("source", "Unknown"),
-                            knowledge_id=item.get("chunk_id"),
-                            metadata={
-                                "score": item.get("score"),
-                                "doc_id": item.get("doc_id"),
-                                "doc_url": item.get("doc_url"),
-                                "knowledge_base_id": item.get("knowledge_base_id"),
-                                "knowledge_base_name": item.get("knowledge_base_name")
-                            }
-                        )
-                        self.doc_manager.add_document(doc)
-                        doc_count += 1
-                        
-                        # 收集元数据用于前端展示
-                        doc_metadata.append({
+                    items = result["results"]
+                    docs = Document.from_retrieval_items(items)
+                    # 批量加入文档管理器(一次去重、一次追加)
+                    self.doc_manager.add_documents(docs)
+                    doc_count = len(docs)
+                    
+                    # 收集元数据用于前端展示
+                    doc_metadata = [
+                        {
                             "title": item.get("source", "Unknown"),
                             "score": item.get("score", 0),
                             "chunk_id": item.get("chunk_id"),
                             "doc_id": item.get("doc_id")
-                        })
+                        }
+                        for item in items
+                    ]
                     
-                    kb_doc_count += doc_count
                     logger.info(f"[{task_id}] ✅ 本次检索到 {doc_count} 个文档")
                 
                 # 通知:查询结束
-                yield {
+                return {
                     "type": "query_end",
                     "task_id": task_id,
                     "kb_name": kb_name,
@@ -369,7 +466,7 @@ class RetrievalAgent:
                 logger.error(f"[{task_id}] ❌ 查询失败: {e}", exc_info=True)
                 
                 # 通知:查询失败
-                yield {
+                return {
                     "type": "query_end",
                     "task_id": task_id,
                     "kb_name": kb_name,
@@ -378,16 +475,6 @@ class RetrievalAgent:
                     "error": str(e),
                     "doc_count": 0
                 }
-        
-        # 通知:知识库检索完成
-        logger.info(f"[{task_id}] ✅ 知识库 {kb_name} 检索完成,共 {kb_doc_count} 个文档")
-        yield {
-            "type": "kb_end",
-            "task_id": task_id,
-            "kb_id": kb_id,
-            "kb_name": kb_name,
-            "total_docs": kb_doc_count
-        }
     
     async def retrieve_with_plan(
         self, 
@@ -427,7 +514,7 @@ class RetrievalAgent:
                 logger.info(f"🔧 执行查询: {query}")
                 
                 # 构造工具调用参数
-                arguments = {
+                arguments: RetrieveKwargs = {
                     "query": query,
                     "top_k": 5,
                     "knowledge_base_id": kb_id
@@ -446,21 +533,9 @@ class RetrievalAgent:
                     
                     # 收集文档
                     if result.get("success") and "results" in result:
-                        for item in result["results"]:
-                            doc = Document(
-                                content=item.get("content", ""),
-                                source=item.get("source", "Unknown"),
-                                knowledge_id=item.get("chunk_id"),
-                                metadata={
-                                    "score": item.get("score"),
-                                    "doc_id": item.get("doc_id"),
-                                    "doc_url": item.get("doc_url"),
-                                    "knowledge_base_id": item.get("knowledge_base_id"),
-                                    "knowledge_base_name": item.get("knowledge_base_name")
-                                }
-                            )
-                            self.doc_manager.add_document(doc)
-                        
+                        # 先构建全部文档,再批量加入文档管理器(一次去重、一次追加)
+                        self.doc_manager.add_documents(Document.from_retrieval_items(result["results"]))
+
                         logger.info(f"✅ 本次检索到 {len(result['results'])} 个文档,总计: {len(self.doc_manager.documents)}")
                     
                     # 通知前端:工具调用结束
@@ -1,17 +1,72 @@
 """
 总结智能体 - 负责基于文档生成带引用的总结
 """
-from openai import AsyncOpenAI
-from typing import AsyncGenerator, Dict, Any
-import json
-import httpx
+from typing import AsyncGenerator, Dict, Any, Iterator, Optional
+import logging
 
 from config.settings import get_settings
+from agents.zhiku.llm.llm_client import get_llm_client, get_llm_semaphore
 from shared.utils.logger import setup_logger
 from shared.utils.document_manager import DocumentManager
+from shared.utils.response_cache import SummaryCache
+from shared.utils.async_utils import buffered
 
 logger = setup_logger("summary_agent")
 
+# 配置: 总结缓存的条目数上限 / 有效期(秒)
+SUMMARY_CACHE_SIZE = 256
+SUMMARY_CACHE_TTL = 3600
+
+# 缓存命中时回放总结内容的分片大小(字符),保持与实时生成一致的流式体验
+REPLAY_CHUNK_SIZE = 40
+
+# 配置: DeepSeek 流式响应的预读缓冲(chunk 数),下游消费变慢时上游读取不被立即阻塞
+STREAM_BUFFER_SIZE = 64
+
+# 总结提示词(固定内容,模块加载时构建一次)
+_SUMMARY_SYSTEM_PROMPT = """你是一个专业的研报分析师。你的任务是基于提供的文档生成高质量的分析报告。
+
+**核心要求**：
+1. **必须使用引用**：在答案中用 [1]、[2] 等标注信息来源
+2. **序号对应文档**：[1] 对应第1个文档，[2] 对应第2个文档，依此类推
+3. **基于事实**：只使用文档中的信息，不编造内容
+4. **专业严谨**：使用正式的学术/商业写作风格
+
+**格式要求**：
+- 使用 Markdown 格式
+- 结构清晰，分点列出
+- 每个要点都标注来源
+
+**示例**：
+根据文档内容，人工智能在金融领域的应用主要包括：
+
+1. **风险控制**[1]：通过机器学习模型预测信用风险...
+2. **智能投顾**[2]：利用深度学习技术提供个性化投资建议...
+3. **反欺诈检测**[1][3]：结合多源数据识别异常交易行为...
+
+## 参考来源
+以上内容基于文档 [1] [2] [3] 的分析整理。"""
+
+
+def _replay(content: str) -> Iterator[Dict[str, Any]]:
+    """
+    将缓存的总结内容按实时生成的事件格式回放
+    
+    Args:
+        content: 完整的总结内容
+        
+    Yields:
+        Dict: content 事件,最后是 summary_complete 事件
+    """
+    for i in range(0, len(content), REPLAY_CHUNK_SIZE):
+        yield {
+            "type": "content",
+            "content": content[i:i + REPLAY_CHUNK_SIZE]
+        }
+    yield {
+        "type": "summary_complete"
+    }
+
 
 class SummaryAgent:
     """
@@ -27,23 +82,20 @@ class SummaryAgent:
     def __init__(self):
         settings = get_settings()
         
-        # 配置超时设置
-        timeout = httpx.Timeout(
-            connect=60.0,  # 连接超时: 60秒
-            read=300.0,    # 读取超时: 5分钟
-            write=300.0,   # 写入超时: 5分钟
-            pool=60.0      # 连接池超时: 60秒
-        )
-        
-        # 初始化 DeepSeek 客户端
-        self.client = AsyncOpenAI(
-            api_key=settings.deepseek_api_key,
-            base_url=settings.deepseek_base_url,
-            timeout=timeout,
-            max_retries=3  # 添加重试机制
-        )
+        # 使用全局共享的 DeepSeek 客户端(共享连接池)
+        self.client = get_llm_client()
         self.model = settings.deepseek_model
         
+        # 每次调用相同的请求参数(每次只需再传入 messages)
+        self._create_kwargs = {
+            "model": self.model,
+            "stream": True,
+            "temperature": 0.7
+        }
+        
+        # 总结结果缓存:相同问题且文档及其顺序一致时直接复用,跳过 LLM 调用
+        self._cache = SummaryCache(maxsize=SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL)
+        
         logger.info(f"总结智能体初始化完成，模型: {self.model}")
     
     async def summarize(
@@ -72,37 +124,24 @@ class SummaryAgent:
         
         # 文档已在协调器中排序,直接使用
         docs_to_use = doc_manager.documents[:max_docs] if max_docs else doc_manager.documents
-        top_docs = [f"{doc.source}(score={doc.metadata.get('score', 0):.2f})" for doc in docs_to_use[:3]]
-        logger.info(f"📄 前3个文档: {top_docs}")
+        if logger.isEnabledFor(logging.INFO):
+            top_docs = [f"{doc.source}(score={doc.metadata.get('score', 0):.2f})" for doc in docs_to_use[:3]]
+            logger.info(f"📄 前3个文档: {top_docs}")
+        
+        # 查询总结缓存(以切片ID标识文档,缺失时退回文档内容;顺序即引用序号)
+        doc_ids = [doc.knowledge_id or doc.content for doc in docs_to_use]
+        cached = self._cache.get(user_query, doc_ids)
+        if cached is not None:
+            logger.info(f"⚡ 命中总结缓存,直接回放 {len(cached)} 字符")
+            for event in _replay(cached):
+                yield event
+            return
         
         # 构建文档上下文(限制文档数量)
         context = doc_manager.get_context_for_llm(max_docs=max_docs)
         logger.info(f"📄 文档上下文长度: {len(context)} 字符")
         
-        # 3. 构建总结提示词
-        system_prompt = """你是一个专业的研报分析师。你的任务是基于提供的文档生成高质量的分析报告。
-
-**核心要求**：
-1. **必须使用引用**：在答案中用 [1]、[2] 等标注信息来源
-2. **序号对应文档**：[1] 对应第1个文档，[2] 对应第2个文档，依此类推
-3. **基于事实**：只使用文档中的信息，不编造内容
-4. **专业严谨**：使用正式的学术/商业写作风格
-
-**格式要求**：
-- 使用 Markdown 格式
-- 结构清晰，分点列出
-- 每个要点都标注来源
-
-**示例**：
-根据文档内容，人工智能在金融领域的应用主要包括：
-
-1. **风险控制**[1]：通过机器学习模型预测信用风险...
-2. **智能投顾**[2]：利用深度学习技术提供个性化投资建议...
-3. **反欺诈检测**[1][3]：结合多源数据识别异常交易行为...
-
-## 参考来源
-以上内容基于文档 [1] [2] [3] 的分析整理。"""
-
+        # 3. 构建总结提示词(系统提示词为模块常量)
         user_message = f"""用户问题:{user_query}
 
 以下是从知识库检索到的相关文档(已按相关性排序),共 {len(docs_to_use)} 个:
@@ -112,39 +151,55 @@ class SummaryAgent:
 请基于以上文档内容,详细回答用户问题。"""
 
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": _SUMMARY_SYSTEM_PROMPT},
             {"role": "user", "content": user_message}
         ]
         
         logger.info("📤 发送请求到 DeepSeek 生成总结...")
         logger.debug(f"   消息数量: {len(messages)}")
-        logger.debug(f"   [0] system: {len(system_prompt)} 字符")
+        logger.debug(f"   [0] system: {len(_SUMMARY_SYSTEM_PROMPT)} 字符")
         logger.debug(f"   [1] user: {len(user_message)} 字符")
         
         try:
-            # 流式调用 DeepSeek（不使用工具）
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                stream=True,
-                temperature=0.7
-            )
-            
-            # 流式输出
-            async for chunk in response:
-                if not chunk.choices:
-                    continue
+            # 流式调用 DeepSeek（不使用工具,受全局并发上限约束）
+            async with get_llm_semaphore():
+                response = await self.client.chat.completions.create(
+                    messages=messages,
+                    **self._create_kwargs
+                )
                 
-                delta = chunk.choices[0].delta
+                # 流式输出(同时累积完整内容,用于写入缓存)
+                # 后台任务持续读取 DeepSeek 响应写入有界缓冲,与下游 SSE 写出重叠进行
+                parts = []
+                chunks = buffered(response, maxsize=STREAM_BUFFER_SIZE)
+                try:
+                    async for chunk in chunks:
+                        # 下游消费落后时,缓冲区中已到达的 chunk 合并为一个 content 事件,
+                        # 减少逐 token 的帧构建与写出;未积压时仍逐 token 输出,不增加延迟
+                        batch = [chunk]
+                        batch.extend(chunks.pop_ready(STREAM_BUFFER_SIZE))
+                        texts = [
+                            c.choices[0].delta.content
+                            for c in batch
+                            if c.choices and c.choices[0].delta.content
+                        ]
+                        
+                        if texts:
+                            parts.extend(texts)
+                            yield {
+                                "type": "content",
+                                "content": "".join(texts)
+                            }
+                finally:
+                    await chunks.aclose()
                 
-                if delta.content:
-                    yield {
-                        "type": "content",
-                        "content": delta.content
-                    }
-            
             logger.info("✅ 总结生成完成")
             
+            # 仅缓存完整生成的总结(出错中断的不缓存)
+            if parts:
+                full_content = "".join(parts)
+                self._cache.put(user_query, doc_ids, full_content)
+            
             # 发送总结完成事件
             yield {
                 "type": "summary_complete"
@@ -156,3 +211,24 @@ class SummaryAgent:
                 "type": "error",
                 "error": str(e)
             }
+
+
+# 全局总结智能体实例
+_summary_agent: Optional[SummaryAgent] = None
+
+
+def get_summary_agent() -> SummaryAgent:
+    """
+    获取全局总结智能体（单例模式）
+    
+    进程内只创建一次,各调用方共享同一份总结缓存
+    
+    Returns:
+        SummaryAgent: 总结智能体
+    """
+    global _summary_agent
+    
+    if _summary_agent is None:
+        _summary_agent = SummaryAgent()
+    
+    return _summary_agent
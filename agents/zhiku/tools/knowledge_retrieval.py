@@ -2,15 +2,192 @@
 知识库检索工具
 封装智谱官方检索 API，提供给 DeepSeek Function Calling 使用
 """
+import asyncio
 import httpx
-from typing import Dict, Any, List
-import json
+import logging
+from typing import Dict, Any, List, Optional, Tuple, TypedDict
+import orjson
 
 from config.settings import get_settings
+from agents.zhiku.llm.llm_client import http2_available
 from shared.utils.logger import setup_logger
+from shared.utils.response_cache import TTLCache, normalize_query
 
 logger = setup_logger("knowledge_retrieval_tool")
 
+# 配置: 检索结果缓存的条目数上限(有效期由 RETRIEVAL_CACHE_TTL 配置)
+RETRIEVAL_CACHE_SIZE = 1024
+
+# 检索结果缓存: (知识库ID, top_k, 归一化查询) -> 成功的检索结果列表(首次检索时创建)
+_retrieval_cache: Optional[TTLCache] = None
+
+# 全局共享的 HTTP 客户端(首次检索时创建)
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+class _Flight:
+    """进行中的检索请求(共享的 HTTP 请求任务及其等待者数量)"""
+    
+    __slots__ = ("task", "waiters")
+    
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+# 进行中的检索请求: 缓存键 -> 共享的请求
+_inflight: Dict[Tuple, _Flight] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    获取智谱检索 API 的 HTTP 客户端(单例模式)
+    
+    所有检索共用一个连接池,复用 keep-alive 连接与 TLS 会话,
+    避免每次检索重新握手;认证头作为客户端默认请求头,无需每次构建
+    
+    Returns:
+        httpx.AsyncClient: 客户端对象
+    """
+    global _http_client
+    
+    if _http_client is None:
+        settings = get_settings()
+        _http_client = httpx.AsyncClient(
+            # 分阶段超时:建连/取连接卡住时快速失败,读取仍保留 30 秒预算
+            timeout=httpx.Timeout(30.0, connect=5.0, write=10.0, pool=5.0),
+            limits=httpx.Limits(
+                max_connections=32,
+                max_keepalive_connections=16,
+                keepalive_expiry=60.0
+            ),
+            headers={
+                "Authorization": f"Bearer {settings.zhipu_api_key}",
+                "Content-Type": "application/json"  # 请求体由 orjson 编码后以 content 发送
+            },
+            http2=http2_available()  # 同一轮的并发检索在一个连接上多路复用
+        )
+    
+    return _http_client
+
+
+async def _post_single_flight(key: Tuple, url: str, payload: Dict[str, Any]) -> httpx.Response:
+    """
+    发送检索请求,相同缓存键的并发请求共享同一次 HTTP 调用
+    
+    请求任务经 shield 等待:某个调用方被取消(如预检索被丢弃)不影响其他等待者;
+    最后一个等待者也被取消时取消 HTTP 请求本身,不为无人使用的结果继续占用连接
+    
+    Args:
+        key: 缓存键(知识库ID, top_k, 归一化查询)
+        url: 检索 API 地址
+        payload: 请求体
+        
+    Returns:
+        httpx.Response: 响应对象(响应体已读取)
+    """
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = _inflight[key] = _Flight(
+            asyncio.ensure_future(get_http_client().post(url, content=orjson.dumps(payload)))
+        )
+        
+        def _on_done(t: asyncio.Future):
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+            # 等待者已全部退出时,避免 "exception was never retrieved" 警告
+            if not t.cancelled():
+                t.exception()
+        
+        flight.task.add_done_callback(_on_done)
+    
+    flight.waiters += 1
+    try:
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # 所有等待者都已取消:取消请求,并立即移出,之后的相同检索重新发起
+            flight.task.cancel()
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+
+
+async def close_http_client():
+    """关闭共享的 HTTP 客户端(应用关闭时调用)"""
+    global _http_client
+    
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# 知识库 ID -> 名称映射(首次使用时从配置构建)
+_kb_names: Optional[Dict[str, str]] = None
+
+
+def _get_kb_name(knowledge_base_id: str) -> str:
+    """
+    根据知识库ID获取显示名称
+    
+    映射只构建一次,之后每次查询为一次字典查找,
+    避免每次检索都重新加载知识库配置并线性扫描
+    
+    Args:
+        knowledge_base_id: 知识库ID
+        
+    Returns:
+        str: 知识库名称,未配置时返回ID本身
+    """
+    global _kb_names
+    
+    if _kb_names is None:
+        try:
+            _kb_names = {kb.id: kb.name for kb in get_settings().get_knowledge_bases()}
+        except Exception as e:
+            logger.warning("加载知识库名称失败: %s", e)
+            return knowledge_base_id
+    
+    return _kb_names.get(knowledge_base_id, knowledge_base_id)
+
+
+def reset_kb_names():
+    """
+    丢弃已构建的知识库名称映射,下次查询时按最新配置重建
+    
+    知识库配置变更(重新加载)后调用
+    """
+    global _kb_names
+    _kb_names = None
+
+
+def _get_retrieval_cache() -> Optional[TTLCache]:
+    """
+    获取检索结果缓存
+    
+    Returns:
+        Optional[TTLCache]: 缓存对象,RETRIEVAL_CACHE_TTL 为 0 (禁用缓存)时返回 None
+    """
+    global _retrieval_cache
+    
+    if _retrieval_cache is None:
+        ttl = get_settings().retrieval_cache_ttl
+        if ttl <= 0:
+            return None
+        _retrieval_cache = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=ttl)
+    
+    return _retrieval_cache
+
+
+def clear_retrieval_cache():
+    """
+    清空检索结果缓存
+    
+    知识库内容更新(文档入库/删除)或知识库配置变更后调用
+    """
+    if _retrieval_cache is not None:
+        _retrieval_cache.clear()
+
 
 # ============================================================
 # 工具定义（DeepSeek Function Calling Schema）
@@ -61,6 +238,13 @@ KNOWLEDGE_RETRIEVAL_TOOL = {
 # 工具执行函数
 # ============================================================
 
+class RetrieveKwargs(TypedDict, total=False):
+    """retrieve_knowledge 的参数(与工具 schema 的 properties 对应)"""
+    query: str
+    top_k: int
+    knowledge_base_id: str
+
+
 async def retrieve_knowledge(query: str, top_k: int = 5, knowledge_base_id: str = None) -> Dict[str, Any]:
     """
     执行知识库检索
@@ -87,7 +271,7 @@ async def retrieve_knowledge(query: str, top_k: int = 5, knowledge_base_id: str
             "query": "原始查询"
         }
     """
-    logger.info(f"[工具调用] retrieve_knowledge: query='{query}', top_k={top_k}, kb_id={knowledge_base_id}")
+    logger.info("[工具调用] retrieve_knowledge: query='%s', top_k=%s, kb_id=%s", query, top_k, knowledge_base_id)
     
     try:
         settings = get_settings()
@@ -97,100 +281,111 @@ async def retrieve_knowledge(query: str, top_k: int = 5, knowledge_base_id: str
             # 使用默认知识库(向后兼容)
             kb_id = settings.zhipu_knowledge_id
             kb_name = "默认知识库"
-            logger.info(f"[INFO] 使用默认知识库: {kb_id}")
+            logger.info("[INFO] 使用默认知识库: %s", kb_id)
         else:
             kb_id = knowledge_base_id
-            # 尝试从配置中获取知识库名称
-            kb_name = knowledge_base_id
-            try:
-                knowledge_bases = settings.get_knowledge_bases()
-                for kb in knowledge_bases:
-                    if kb.id == knowledge_base_id:
-                        kb_name = kb.name
-                        break
-            except:
-                pass
+            # 从配置中获取知识库名称
+            kb_name = _get_kb_name(knowledge_base_id)
+        
+        top_k = min(max(top_k, 1), 20)  # 限制在 1-20 范围内
+        
+        # 相同知识库的相同查询直接复用缓存结果,跳过 HTTP 请求
+        cache = _get_retrieval_cache()
+        cache_key = (kb_id, top_k, normalize_query(query))
+        cached = cache.get(cache_key) if cache is not None else None
+        if cached is not None:
+            logger.info("[缓存] 知识库 '%s' 命中检索缓存,%d 个文档", kb_name, len(cached))
+            return {
+                "success": True,
+                "results": cached,
+                "count": len(cached),
+                "query": query,
+                "cached": True
+            }
         
         # 智谱知识库检索 API 端点（官方）
         url = "https://open.bigmodel.cn/api/llm-application/open/knowledge/retrieve"
         
-        # 请求头
-        headers = {
-            "Authorization": f"Bearer {settings.zhipu_api_key}",
-            "Content-Type": "application/json"
-        }
-        
         # 请求体
         payload = {
             "query": query,
             "knowledge_ids": [kb_id],  # 使用指定的知识库ID
-            "top_k": min(max(top_k, 1), 20),  # 限制在 1-20 范围内
+            "top_k": top_k,
             "recall_method": "mixed",  # 混合检索（向量+关键词）
             "recall_ratio": 80,  # 向量检索权重 80%
             "rerank_status": 1,  # 启用重排
             "rerank_model": "rerank"  # 使用重排模型
         }
         
-        logger.debug(f"[DEBUG] 请求 URL: {url}")
-        logger.debug(f"[DEBUG] 请求 payload: {json.dumps(payload, ensure_ascii=False)}")
+        # 调试日志的参数(序列化 payload、解码响应体)开销不小,仅在 DEBUG 级别开启时构建
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("[DEBUG] 请求 URL: %s", url)
+            logger.debug("[DEBUG] 请求 payload: %s", orjson.dumps(payload).decode())
         
-        # 发送请求
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=payload, headers=headers)
-            
-            logger.debug(f"[DEBUG] 响应状态码: {response.status_code}")
-            logger.debug(f"[DEBUG] 响应内容: {response.text[:500]}...")
+        # 发送请求(与进行中的相同检索合并)
+        response = await _post_single_flight(cache_key, url, payload)
+        
+        if debug:
+            logger.debug("[DEBUG] 响应状态码: %s", response.status_code)
+            # 只解码前 500 字节,不为截取前缀而解码整个响应体
+            logger.debug("[DEBUG] 响应内容: %s...", response.content[:500].decode("utf-8", "replace"))
+        
+        # 解析响应
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
             
-            # 解析响应
-            if response.status_code == 200:
-                data = response.json()
-                
-                # 检查业务状态码
-                if data.get("code") == 200:
-                    results = []
-                    
-                    for item in data.get("data", []):
-                        results.append({
-                            "content": item.get("text", ""),
-                            "source": item.get("metadata", {}).get("doc_name", "Unknown"),
-                            "score": item.get("score", 0),
-                            "chunk_id": item.get("metadata", {}).get("_id"),  # 切片ID（唯一）
-                            "doc_id": item.get("metadata", {}).get("doc_id"),  # 文档ID（同一文章相同）
-                            "doc_url": item.get("metadata", {}).get("doc_url"),
-                            "knowledge_base_id": kb_id,  # 添加知识库ID
-                            "knowledge_base_name": kb_name  # 添加知识库名称
-                        })
-                    
-                    logger.info(f"[成功] 从知识库 '{kb_name}' 检索到 {len(results)} 个文档")
-                    
-                    return {
-                        "success": True,
-                        "results": results,
-                        "count": len(results),
-                        "query": query
-                    }
-                else:
-                    # 业务错误
-                    error_msg = data.get("message", "Unknown error")
-                    logger.error(f"[失败] 业务错误: {error_msg}")
-                    
-                    return {
-                        "success": False,
-                        "error": f"检索失败: {error_msg}",
-                        "query": query
+            # 检查业务状态码
+            if data.get("code") == 200:
+                # 单次推导构建结果(每个条目的 metadata 只取一次)
+                results = [
+                    {
+                        "content": item.get("text", ""),
+                        "source": metadata.get("doc_name", "Unknown"),
+                        "score": item.get("score", 0),
+                        "chunk_id": metadata.get("_id"),  # 切片ID（唯一）
+                        "doc_id": metadata.get("doc_id"),  # 文档ID（同一文章相同）
+                        "doc_url": metadata.get("doc_url"),
+                        "knowledge_base_id": kb_id,  # 添加知识库ID
+                        "knowledge_base_name": kb_name  # 添加知识库名称
                     }
+                    for item in data.get("data", ())
+                    for metadata in (item.get("metadata", {}),)
+                ]
+                
+                logger.info("[成功] 从知识库 '%s' 检索到 %d 个文档", kb_name, len(results))
+                if cache is not None:
+                    cache.put(cache_key, results)
+                
+                return {
+                    "success": True,
+                    "results": results,
+                    "count": len(results),
+                    "query": query
+                }
             else:
-                # HTTP 错误
-                logger.error(f"[失败] HTTP 错误: {response.status_code} - {response.text}")
+                # 业务错误
+                error_msg = data.get("message", "Unknown error")
+                logger.error("[失败] 业务错误: %s", error_msg)
                 
                 return {
                     "success": False,
-                    "error": f"HTTP {response.status_code}: {response.text[:200]}",
+                    "error": f"检索失败: {error_msg}",
                     "query": query
                 }
-    
+        else:
+            # HTTP 错误(只解码响应体前 200 字节,错误页可能很大)
+            body_preview = response.content[:200].decode("utf-8", "replace")
+            logger.error("[失败] HTTP 错误: %d - %s", response.status_code, body_preview)
+            
+            return {
+                "success": False,
+                "error": f"HTTP {response.status_code}: {body_preview}",
+                "query": query
+            }
+
     except httpx.TimeoutException:
-        logger.error(f"[失败] 请求超时")
+        logger.error("[失败] 请求超时")
         return {
             "success": False,
             "error": "请求超时，请稍后重试",
@@ -198,7 +393,7 @@ async def retrieve_knowledge(query: str, top_k: int = 5, knowledge_base_id: str
         }
     
     except Exception as e:
-        logger.error(f"[失败] 异常: {e}", exc_info=True)
+        logger.error("[失败] 异常: %s", e, exc_info=True)
         return {
             "success": False,
             "error": f"检索异常: {str(e)}",
@@ -2,11 +2,12 @@
 配置管理模块
 从 .env 文件加载配置项,并提供全局访问接口
 """
-from pydantic import BaseModel
-from pydantic_settings import BaseSettings
+from pydantic import BaseModel, PrivateAttr
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional, List
 import os
-import json
+
+import orjson
 
 
 class KnowledgeBaseConfig(BaseModel):
@@ -16,11 +17,19 @@ class KnowledgeBaseConfig(BaseModel):
     description: str                 # 详细描述(供规划智能体理解)
     domain: str = "general"          # 领域标签(如:金融、科技、医疗)
     priority: int = 0                # 优先级(可选)
+    domain_keywords: List[str] = []  # 领域关键词(可选,用于跳过 LLM 的规则规划)
 
 
 class Settings(BaseSettings):
     """应用配置类"""
     
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_file_encoding="utf-8",
+        case_sensitive=False,
+        extra="ignore"  # .env 中的未知配置项直接忽略,不报错
+    )
+    
     # 智谱 AI 配置
     zhipu_api_key: str
     zhipu_knowledge_id: str = "2010913086994870272"  # 兼容旧配置:默认知识库 ID
@@ -29,14 +38,22 @@ class Settings(BaseSettings):
     knowledge_bases_json: Optional[str] = None
     knowledge_bases_file: str = "config/knowledge_bases.json"
     
+    # 检索结果缓存有效期(秒),相同知识库的相同查询在有效期内不再请求检索 API;设为 0 禁用缓存
+    retrieval_cache_ttl: int = 1800
+    
     # DeepSeek 配置
     deepseek_api_key: str
     deepseek_base_url: str = "https://api.deepseek.com"
     deepseek_model: str = "deepseek-chat"
+    llm_max_concurrency: int = 64    # 全进程同时在途的 LLM 调用上限(按 DeepSeek 限流调整)
     
     # 日志配置
     log_level: str = "debug"
     
+    # SSE 流式输出配置(模拟打字效果: 每帧字符数 / 帧间隔秒数, 间隔为 0 时不做服务端节奏控制)
+    stream_chunk_size: int = 8
+    stream_chunk_delay: float = 0.02
+    
     # 服务器配置
     host: str = "0.0.0.0"
     port: int = 8000
@@ -44,38 +61,55 @@ class Settings(BaseSettings):
     # 智能体注册表
     agents_config: str = "config/agents.yaml"
     
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
-        case_sensitive = False
+    # 已解析的知识库列表(首次调用 get_knowledge_bases 时加载)
+    _kb_cache: Optional[List[KnowledgeBaseConfig]] = PrivateAttr(default=None)
     
-    def get_knowledge_bases(self) -> List[KnowledgeBaseConfig]:
+    def get_knowledge_bases(self, reload: bool = False) -> List[KnowledgeBaseConfig]:
         """
         获取知识库列表
         
+        首次调用时解析并缓存,之后直接返回缓存的列表(调用方不应修改)
+        
         优先级:
         1. KNOWLEDGE_BASES_JSON 环境变量
         2. knowledge_bases.json 文件
         3. 使用默认知识库(向后兼容)
         
+        Args:
+            reload: 是否重新读取配置(knowledge_bases.json 在运行期变更后使用)
+        
         Returns:
             List[KnowledgeBaseConfig]: 知识库配置列表
         """
+        if self._kb_cache is None or reload:
+            self._kb_cache = self._load_knowledge_bases()
+        return self._kb_cache
+    
+    def _load_knowledge_bases(self) -> List[KnowledgeBaseConfig]:
+        """
+        按优先级解析知识库配置
+        
+        Returns:
+            List[KnowledgeBaseConfig]: 知识库配置列表
+        """
+        # 两种来源统一用 orjson 解析;解析失败(orjson.JSONDecodeError)与字段校验失败
+        # (pydantic ValidationError)均为 ValueError,条目不是对象时为 TypeError
+        
         # 方式1: 从环境变量加载
         if self.knowledge_bases_json:
             try:
-                data = json.loads(self.knowledge_bases_json)
+                data = orjson.loads(self.knowledge_bases_json)
                 return [KnowledgeBaseConfig(**kb) for kb in data]
-            except Exception as e:
+            except (ValueError, TypeError) as e:
                 print(f"[WARNING] 解析 KNOWLEDGE_BASES_JSON 失败: {e}")
         
         # 方式2: 从文件加载
         if os.path.exists(self.knowledge_bases_file):
             try:
-                with open(self.knowledge_bases_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                with open(self.knowledge_bases_file, 'rb') as f:
+                    data = orjson.loads(f.read())
                     return [KnowledgeBaseConfig(**kb) for kb in data]
-            except Exception as e:
+            except (OSError, ValueError, TypeError) as e:
                 print(f"[WARNING] 加载 {self.knowledge_bases_file} 失败: {e}")
         
         # 方式3: 使用默认知识库(向后兼容)
@@ -96,9 +130,16 @@ class Settings(BaseSettings):
 _settings: Optional[Settings] = None
 
 
-def get_settings() -> Settings:
+# 必填项: (配置字段, 环境变量名, .env.example 中的占位值)
+_REQUIRED_KEYS = (
+    ("zhipu_api_key", "ZHIPU_API_KEY", "your_zhipu_api_key_here"),
+    ("deepseek_api_key", "DEEPSEEK_API_KEY", "your_deepseek_api_key_here"),
+)
+
+
+def _load_settings() -> Settings:
     """
-    获取全局配置实例（单例模式）
+    首次加载配置
     
     Returns:
         Settings: 配置对象
@@ -108,19 +149,35 @@ def get_settings() -> Settings:
     """
     global _settings
     
-    if _settings is None:
-        try:
-            _settings = Settings()
-        except Exception as e:
-            raise ValueError(
-                f"配置加载失败: {e}\n"
-                "请确保 .env 文件存在且包含所有必要的配置项。\n"
-                "参考 .env.example 文件进行配置。"
-            )
+    try:
+        _settings = Settings()
+    except Exception as e:
+        raise ValueError(
+            f"配置加载失败: {e}\n"
+            "请确保 .env 文件存在且包含所有必要的配置项。\n"
+            "参考 .env.example 文件进行配置。"
+        )
     
     return _settings
 
 
+def get_settings() -> Settings:
+    """
+    获取全局配置实例（单例模式）
+    
+    已加载时直接返回,加载与错误处理仅在首次调用时执行
+    
+    Returns:
+        Settings: 配置对象
+        
+    Raises:
+        ValueError: 如果缺少必要的配置项
+    """
+    if _settings is not None:
+        return _settings
+    return _load_settings()
+
+
 def validate_config() -> bool:
     """
     验证配置是否完整
@@ -131,14 +188,12 @@ def validate_config() -> bool:
     try:
         settings = get_settings()
         
-        # 检查必填项
-        if not settings.zhipu_api_key or settings.zhipu_api_key == "your_zhipu_api_key_here":
-            print("[ERROR] 错误: 请在 .env 文件中配置 ZHIPU_API_KEY")
-            return False
-            
-        if not settings.deepseek_api_key or settings.deepseek_api_key == "your_deepseek_api_key_here":
-            print("[ERROR] 错误: 请在 .env 文件中配置 DEEPSEEK_API_KEY")
-            return False
+        # 检查必填项(未配置或仍为占位值)
+        for field, env_name, placeholder in _REQUIRED_KEYS:
+            value = getattr(settings, field)
+            if not value or value == placeholder:
+                print(f"[ERROR] 错误: 请在 .env 文件中配置 {env_name}")
+                return False
         
         print("[OK] 配置验证通过")
         return True
@@ -2,6 +2,9 @@
 API 网关
 聚合所有智能体的路由
 """
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -11,6 +14,25 @@ from shared.utils.logger import setup_logger
 logger = setup_logger("api_gateway")
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期
+    
+    启动时在后台预热共享的 DeepSeek 连接池(不阻塞服务就绪),
+    关闭时释放 DeepSeek 与检索 API 的连接池
+    """
+    # 在此导入:模块加载时不引入 LLM SDK 与 HTTP 客户端
+    from agents.zhiku.llm.llm_client import close_llm_client, warmup
+    from agents.zhiku.tools.knowledge_retrieval import close_http_client
+    
+    warmup_task = asyncio.create_task(warmup())
+    yield
+    warmup_task.cancel()
+    await close_http_client()
+    await close_llm_client()
+
+
 def create_app() -> FastAPI:
     """
     创建 FastAPI 应用
@@ -21,7 +43,8 @@ def create_app() -> FastAPI:
     app = FastAPI(
         title="AI 智能体平台",
         description="多智能体协作平台，提供知识检索、代码生成等服务",
-        version="2.0.0"
+        version="2.0.0",
+        lifespan=lifespan
     )
     
     # 配置 CORS
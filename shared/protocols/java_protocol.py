@@ -3,9 +3,10 @@ Java 标准消息协议适配器
 将内部事件转换为 Java 后端定义的标准格式
 """
 from enum import Enum
-from typing import Dict, Any, List, Optional
-import json
-import uuid
+from typing import Dict, Any, List, Optional, Union
+import hashlib
+
+import orjson
 
 
 # ============================================================
@@ -47,6 +48,18 @@ class InvocationType(str, Enum):
     ANALYZE = "analyze"
 
 
+# 构建器中固定使用的枚举值,模块加载时取出,省去每次调用的枚举属性查找
+_STATUS_CHANGE = ChangeType.STATUS_CHANGE.value
+_CONTENT_APPEND = ChangeType.CONTENT_APPEND.value
+_COMPLETED = StageStatus.COMPLETED.value
+
+# 调用完成时固定的状态变更条目,各消息共享引用(只读,勿修改)
+_STATUS_COMPLETED_MESSAGE = {
+    "change_type": _STATUS_CHANGE,
+    "status": _COMPLETED
+}
+
+
 # ============================================================
 # Stage 定义
 # ============================================================
@@ -71,20 +84,37 @@ class StageDefinition:
         "description": "基于检索结果生成带引用的总结"
     }
     
+    # 初始状态(PENDING)的阶段列表,类定义时合并一次
+    _PENDING_STAGES = tuple(
+        {**stage, "status": StageStatus.PENDING.value}
+        for stage in (PLANNING, RETRIEVAL, SUMMARY)
+    )
+    
     @classmethod
     def get_all_stages(cls) -> List[Dict[str, str]]:
-        """获取所有阶段定义"""
-        return [
-            {**cls.PLANNING, "status": StageStatus.PENDING.value},
-            {**cls.RETRIEVAL, "status": StageStatus.PENDING.value},
-            {**cls.SUMMARY, "status": StageStatus.PENDING.value}
-        ]
+        """获取所有阶段定义(每次返回新副本,调用方可自由修改)"""
+        return [dict(stage) for stage in cls._PENDING_STAGES]
 
 
 # ============================================================
 # 基础消息构建器
 # ============================================================
 
+def _content_string(content: Union[str, Dict[str, Any], List[Any]]) -> str:
+    """
+    将结构化内容序列化为 JSON 字符串（协议约定 content 字段为字符串）
+    
+    Args:
+        content: 文本内容，或需序列化的 dict/list
+        
+    Returns:
+        str: 原样返回的文本，或 dict/list 的 JSON 字符串
+    """
+    if isinstance(content, str):
+        return content
+    return orjson.dumps(content).decode("utf-8")
+
+
 def build_java_message(
     event_type: JavaEventType,
     context: Dict[str, Any],
@@ -138,6 +168,10 @@ def build_context(
     return context
 
 
+# 默认上下文(仅 mode),模块加载时构建一次,各消息共享引用(只读,勿修改)
+_DEFAULT_CONTEXT = build_context()
+
+
 # ============================================================
 # PLAN 相关消息构建器
 # ============================================================
@@ -151,7 +185,7 @@ def build_plan_declared() -> Dict[str, Any]:
     """
     return build_java_message(
         event_type=JavaEventType.PLAN_DECLARED,
-        context=build_context(),
+        context=_DEFAULT_CONTEXT,
         messages=StageDefinition.get_all_stages()
     )
 
@@ -169,9 +203,9 @@ def build_plan_change_status(stage_id: str, status: StageStatus) -> Dict[str, An
     """
     return build_java_message(
         event_type=JavaEventType.PLAN_CHANGE,
-        context=build_context(),
+        context=_DEFAULT_CONTEXT,
         messages=[{
-            "change_type": ChangeType.STATUS_CHANGE.value,
+            "change_type": _STATUS_CHANGE,
             "stage_id": stage_id,
             "status": status.value
         }]
@@ -182,6 +216,10 @@ def build_plan_change_status(stage_id: str, status: StageStatus) -> Dict[str, An
 # STREAM 相关消息构建器
 # ============================================================
 
+_STREAM_THINK = JavaEventType.STREAM_THING.value
+_STREAM_CONTENT = JavaEventType.STREAM_CONTENT.value
+
+
 def build_stream_thing(content: str) -> Dict[str, Any]:
     """
     构建思考过程流式消息
@@ -192,11 +230,12 @@ def build_stream_thing(content: str) -> Dict[str, Any]:
     Returns:
         Dict: STREAM_THING 消息
     """
-    return build_java_message(
-        event_type=JavaEventType.STREAM_THING,
-        context=build_context(),
-        messages=[{"content": content}]
-    )
+    # 热路径(逐块调用):直接构造字典并复用默认上下文,省去函数调用与上下文字典分配
+    return {
+        "event_type": _STREAM_THINK,
+        "context": _DEFAULT_CONTEXT,
+        "messages": [{"content": content}]
+    }
 
 
 def build_stream_content(content: str) -> Dict[str, Any]:
@@ -209,11 +248,12 @@ def build_stream_content(content: str) -> Dict[str, Any]:
     Returns:
         Dict: STREAM_CONTENT 消息
     """
-    return build_java_message(
-        event_type=JavaEventType.STREAM_CONTENT,
-        context=build_context(),
-        messages=[{"content": content}]
-    )
+    # 热路径(逐块调用):直接构造字典并复用默认上下文,省去函数调用与上下文字典分配
+    return {
+        "event_type": _STREAM_CONTENT,
+        "context": _DEFAULT_CONTEXT,
+        "messages": [{"content": content}]
+    }
 
 
 # ============================================================
@@ -284,7 +324,7 @@ def build_invocation_change_status(
             executor=executor
         ),
         messages=[{
-            "change_type": ChangeType.STATUS_CHANGE.value,
+            "change_type": _STATUS_CHANGE,
             "status": status.value
         }]
     )
@@ -316,7 +356,7 @@ def build_invocation_change_content(
             executor=executor
         ),
         messages=[{
-            "change_type": ChangeType.CONTENT_APPEND.value,
+            "change_type": _CONTENT_APPEND,
             "content": content
         }]
     )
@@ -325,7 +365,7 @@ def build_invocation_change_content(
 def build_invocation_complete(
     stage_id: str,
     invocation_id: str,
-    content: str,
+    content: Union[str, Dict[str, Any], List[Any]],
     executor: str = "retrieval-agent"
 ) -> Dict[str, Any]:
     """
@@ -334,7 +374,7 @@ def build_invocation_complete(
     Args:
         stage_id: 阶段ID
         invocation_id: 调用ID
-        content: 结果内容
+        content: 结果内容（dict/list 在此序列化为 JSON 字符串，调用方无需预先转换）
         executor: 执行器
         
     Returns:
@@ -348,13 +388,10 @@ def build_invocation_complete(
             executor=executor
         ),
         messages=[
+            _STATUS_COMPLETED_MESSAGE,
             {
-                "change_type": ChangeType.STATUS_CHANGE.value,
-                "status": StageStatus.COMPLETED.value
-            },
-            {
-                "change_type": ChangeType.CONTENT_APPEND.value,
-                "content": content
+                "change_type": _CONTENT_APPEND,
+                "content": _content_string(content)
             }
         ]
     )
@@ -411,7 +448,7 @@ def build_artifact(
 def build_artifact_change(
     stage_id: str,
     artifact_id: str,
-    content: str,
+    content: Union[str, Dict[str, Any], List[Any]],
     change_type: str = "CONTENT_APPEND",
     artifact_name: str = "",
     artifact_type: str = "",
@@ -425,7 +462,7 @@ def build_artifact_change(
     Args:
         stage_id: 阶段ID
         artifact_id: 产物ID
-        content: 追加的内容
+        content: 追加的内容（dict/list 在此序列化为 JSON 字符串，调用方无需预先转换）
         change_type: 变更类型（CONTENT_APPEND）
         artifact_name: 产物名称（可选）
         artifact_type: 产物类型（可选）
@@ -440,7 +477,7 @@ def build_artifact_change(
         "scope": scope,
         "change_type": change_type,
         "data_type": data_type,
-        "content": content
+        "content": _content_string(content)
     }
     
     # 可选字段
@@ -476,7 +513,7 @@ def build_end() -> Dict[str, Any]:
     """
     return build_java_message(
         event_type=JavaEventType.END,
-        context=build_context(),
+        context=_DEFAULT_CONTEXT,
         messages=[]
     )
 
@@ -485,6 +522,19 @@ def build_end() -> Dict[str, Any]:
 # 工具函数
 # ============================================================
 
+def encode_message(msg: Dict[str, Any]) -> bytes:
+    """
+    编码 Java 标准格式消息
+    
+    Args:
+        msg: build_* 构建的消息
+        
+    Returns:
+        bytes: UTF-8 JSON（各枚举字段在构建时已取 .value，无需自定义 default）
+    """
+    return orjson.dumps(msg)
+
+
 def generate_invocation_id(kb_name: str, query: str, task_id: str = "") -> str:
     """
     生成调用ID（确定性，保证同一查询的 DECLARED 和 CHANGE 使用相同ID）
@@ -497,11 +547,9 @@ def generate_invocation_id(kb_name: str, query: str, task_id: str = "") -> str:
     Returns:
         str: 调用ID
     """
-    import hashlib
-    
     # 使用知识库名称、查询内容和任务ID的组合生成确定性哈希
     content = f"{kb_name}::{query}::{task_id}"
-    hash_value = hashlib.md5(content.encode('utf-8')).hexdigest()[:8]
+    hash_value = hashlib.blake2b(content.encode('utf-8'), digest_size=4).hexdigest()
     
     # 生成可读的ID
     kb_short = kb_name[:10].replace(" ", "-")
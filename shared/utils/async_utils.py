@@ -0,0 +1,183 @@
+"""
+异步工具模块
+提供异步迭代器的预取缓冲等通用能力
+"""
+import asyncio
+import inspect
+from typing import AsyncIterator, List, TypeVar
+
+T = TypeVar("T")
+
+_SENTINEL = object()  # 源迭代器结束标记
+
+
+async def _close_source(source):
+    """
+    关闭源迭代器,释放其持有的连接等资源
+
+    异步生成器提供 aclose();openai 的 AsyncStream 等只提供 close(),两者都需兼容
+
+    Args:
+        source: 源异步迭代器
+    """
+    close = getattr(source, "aclose", None) or getattr(source, "close", None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+
+class _Failure:
+    """源迭代器抛出的异常(经队列传递给消费者)"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _Buffered:
+    """
+    预取缓冲的异步迭代器实现
+
+    构造时立即启动后台拉取任务(而非首次迭代时),
+    使源迭代器在消费者开始迭代之前就能提前产出元素
+    """
+
+    def __init__(self, source: AsyncIterator[T], maxsize: int):
+        self._source = source
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._finished = False
+        self._pending = None  # pop_ready() 取到的结束标记/异常,留给下一次 __anext__ 处理
+        self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        queue = self._queue
+        source = self._source
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_SENTINEL)
+        except Exception as e:
+            await queue.put(_Failure(e))
+        finally:
+            # 被取消时及时关闭源迭代器,释放其持有的连接等资源
+            await _close_source(source)
+
+    def __aiter__(self) -> "_Buffered":
+        return self
+
+    async def __anext__(self) -> T:
+        if self._finished:
+            raise StopAsyncIteration
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+        else:
+            item = await self._queue.get()
+        if item is _SENTINEL:
+            self._finished = True
+            raise StopAsyncIteration
+        if isinstance(item, _Failure):
+            self._finished = True
+            raise item.error
+        return item
+
+    def pop_ready(self, limit: int) -> List[T]:
+        """
+        取出缓冲区中已就绪的元素(不等待)
+
+        消费者落后于上游时,可借此把积压的多个元素合并处理;
+        遇到结束标记或异常时停止,由下一次迭代照常结束或抛出
+
+        Args:
+            limit: 最多取出的元素个数
+
+        Returns:
+            List: 已就绪的元素(可能为空)
+        """
+        items = []
+        queue = self._queue
+        while len(items) < limit and self._pending is None and not queue.empty():
+            item = queue.get_nowait()
+            if item is _SENTINEL or isinstance(item, _Failure):
+                self._pending = item
+            else:
+                items.append(item)
+        return items
+
+    async def aclose(self):
+        """
+        消费者提前退出(如客户端断开)时取消预取任务
+
+        等待任务真正结束,源生成器的清理(finally)在返回前完成
+        """
+        self._finished = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            # 调用方自身被取消时继续传播,否则只是预取任务已取消
+            current = asyncio.current_task()
+            if current is not None and current.cancelling():
+                raise
+
+
+def buffered(source: AsyncIterator[T], maxsize: int = 8) -> AsyncIterator[T]:
+    """
+    带预取缓冲的异步迭代器
+
+    后台任务持续拉取 source 的下一个元素放入有界队列,
+    使上游生产与下游消费(编码、写出)可以重叠进行。
+    拉取任务在调用时即启动,调用方可先处理其他工作再开始迭代
+    (需在运行中的事件循环内调用)
+
+    Args:
+        source: 源异步迭代器
+        maxsize: 缓冲区大小(上游最多领先的元素个数)
+
+    Returns:
+        AsyncIterator: 源迭代器的元素(顺序不变,源迭代器的异常原样抛出),
+                       使用完毕或提前退出时应调用 aclose()
+    """
+    return _Buffered(source, maxsize)
+
+
+async def merged(sources: List[AsyncIterator[T]], maxsize: int = 0) -> AsyncIterator[T]:
+    """
+    合并多个异步迭代器
+
+    每个源由独立的后台任务拉取并写入同一队列,
+    任一源产出元素即可立即交给消费者(而非等某个源全部结束)
+
+    Args:
+        sources: 源异步迭代器列表
+        maxsize: 队列大小(0 表示不限制)
+
+    Yields:
+        各源的元素(同一源内顺序不变,任一源的异常原样抛出)
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    async def pump(source: AsyncIterator[T]):
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_SENTINEL)
+        except Exception as e:
+            await queue.put(_Failure(e))
+        finally:
+            await _close_source(source)
+
+    tasks = [asyncio.create_task(pump(source)) for source in sources]
+    try:
+        pending = len(tasks)
+        while pending:
+            item = await queue.get()
+            if item is _SENTINEL:
+                pending -= 1
+                continue
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        # 消费者提前退出或出错时取消其余拉取任务
+        for task in tasks:
+            task.cancel()
@@ -3,15 +3,22 @@
 负责文档去重和全局引用索引管理
 """
 import hashlib
-from typing import List, Dict, Any, Optional
+import heapq
+from typing import List, Dict, Any, Optional, Union
 from shared.utils.logger import setup_logger
 
 logger = setup_logger("document_manager")
 
+# 参考文献中内容预览的最大字符数
+PREVIEW_LENGTH = 100
+
 
 class Document:
     """文档数据类"""
     
+    # 固定属性集合:省去每个实例的 __dict__,降低内存占用与属性访问开销
+    __slots__ = ("content", "source", "knowledge_id", "metadata", "index", "_preview")
+    
     def __init__(
         self,
         content: str,
@@ -24,6 +31,44 @@ class Document:
         self.knowledge_id = knowledge_id
         self.metadata = metadata or {}
         self.index: Optional[int] = None  # 全局引用索引
+        self._preview: Optional[str] = None  # 内容预览(首次访问时生成)
+    
+    @classmethod
+    def from_retrieval_items(cls, items: List[Dict[str, Any]]) -> List["Document"]:
+        """
+        根据检索结果批量构建文档
+        
+        Args:
+            items: retrieve_knowledge 返回的 results 列表
+            
+        Returns:
+            List[Document]: 文档列表(顺序与 items 一致)
+        """
+        return [
+            cls(
+                content=item.get("content", ""),
+                source=item.get("source", "Unknown"),
+                knowledge_id=item.get("chunk_id"),
+                metadata={
+                    "score": item.get("score"),
+                    "doc_id": item.get("doc_id"),
+                    "doc_url": item.get("doc_url"),
+                    "knowledge_base_id": item.get("knowledge_base_id"),
+                    "knowledge_base_name": item.get("knowledge_base_name")
+                }
+            )
+            for item in items
+        ]
+    
+    @property
+    def preview(self) -> str:
+        """内容预览(超过 PREVIEW_LENGTH 时截断并加省略号),每个文档只计算一次"""
+        preview = self._preview
+        if preview is None:
+            content = self.content
+            preview = content[:PREVIEW_LENGTH] + "..." if len(content) > PREVIEW_LENGTH else content
+            self._preview = preview
+        return preview
     
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典格式"""
@@ -48,11 +93,11 @@ class DocumentManager:
     
     def __init__(self):
         self.documents: List[Document] = []  # 存储唯一文档
-        self.doc_hash_map: Dict[str, int] = {}  # 哈希 -> 索引映射
+        self.doc_hash_map: Dict[Union[str, int], int] = {}  # 去重键 -> 索引映射
         
-    def _compute_hash(self, doc: Document) -> str:
+    def _compute_hash(self, doc: Document) -> Union[str, int]:
         """
-        计算文档哈希值
+        计算文档去重键
         
         使用切片ID（chunk_id）或内容哈希来去重
         注意：不使用文档ID（doc_id），因为同一文档的不同切片需要保留
@@ -61,15 +106,17 @@ class DocumentManager:
             doc: 文档对象
             
         Returns:
-            str: MD5 哈希值
+            Union[str, int]: 切片ID 本身（str），或内容的 64 位 BLAKE2b 摘要（int）；
+                             两者类型不同，不会互相冲突
         """
-        # 优先使用 knowledge_id（切片ID），如果没有则使用内容哈希
+        # 优先使用 knowledge_id（切片ID）：本身已唯一且很短，直接作为键，无需再哈希
         if doc.knowledge_id:
-            hash_source = doc.knowledge_id
-        else:
-            hash_source = doc.content
+            return doc.knowledge_id
         
-        return hashlib.md5(hash_source.encode('utf-8')).hexdigest()
+        # 否则使用内容哈希：去重不需要密码学强度，BLAKE2b 为标准库内置实现，比 MD5 更快；
+        # 64 位摘要转为 int 作为键，比字符串/字节串键更省内存，字典查找也更快
+        digest = hashlib.blake2b(doc.content.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
     
     def add_document(self, doc: Document) -> int:
         """
@@ -84,8 +131,9 @@ class DocumentManager:
         doc_hash = self._compute_hash(doc)
         
         # 如果已存在，返回已有索引
-        if doc_hash in self.doc_hash_map:
-            return self.doc_hash_map[doc_hash]
+        existing = self.doc_hash_map.get(doc_hash)
+        if existing is not None:
+            return existing
         
         # 添加新文档
         index = len(self.documents) + 1
@@ -105,7 +153,30 @@ class DocumentManager:
         Returns:
             List[int]: 每个文档的全局索引列表
         """
-        return [self.add_document(doc) for doc in docs]
+        documents = self.documents
+        doc_hash_map = self.doc_hash_map
+        compute_hash = self._compute_hash
+        
+        indices = []
+        new_docs = []
+        next_index = len(documents) + 1
+        for doc in docs:
+            doc_hash = compute_hash(doc)
+            index = doc_hash_map.get(doc_hash)
+            if index is None:
+                # 新文档（批内重复同样按哈希去重）
+                index = next_index
+                next_index += 1
+                doc.index = index
+                doc_hash_map[doc_hash] = index
+                new_docs.append(doc)
+            indices.append(index)
+        
+        # 一次性追加所有新文档
+        if new_docs:
+            documents.extend(new_docs)
+        
+        return indices
     
     def get_document(self, index: int) -> Optional[Document]:
         """
@@ -125,33 +196,44 @@ class DocumentManager:
         """获取所有文档"""
         return self.documents.copy()
     
-    def sort_documents(self, key: str = "score", reverse: bool = True):
+    def sort_documents(self, key: str = "score", reverse: bool = True, top_k: Optional[int] = None):
         """
         对文档进行排序并重新分配引用序号
         
         Args:
             key: 排序依据的metadata字段，默认为 "score"（相似度分数）
             reverse: 是否降序排序，默认 True（分数高的在前）
+            top_k: 只需前 k 个文档有序时传入（如只取前 N 个送入总结），
+                   用堆选出前 k 个，其余文档保持原顺序排在后面；None 表示全量排序
         
         注意：
         - 排序后会重新分配 index（1, 2, 3...）
         - 原始的 chunk_id 保留在 knowledge_id 中
         """
         try:
-            # 按指定字段排序
-            self.documents.sort(
-                key=lambda doc: doc.metadata.get(key, 0) if doc.metadata else 0,
-                reverse=reverse
-            )
+            # metadata 在构造时已归一为 dict（可能为空），无需再判空；
+            # 排序键对每个文档只计算一次，不随比较次数增加
+            sort_key = lambda doc: doc.metadata.get(key, 0)
+            
+            if top_k is not None and top_k < len(self.documents):
+                # 部分排序：O(N log k)，结果与全量排序的前 k 个一致
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                top = select(top_k, self.documents, key=sort_key)
+                chosen = {id(doc) for doc in top}
+                top.extend(doc for doc in self.documents if id(doc) not in chosen)
+                self.documents[:] = top
+            else:
+                # 按指定字段排序
+                self.documents.sort(key=sort_key, reverse=reverse)
             
             # 重新分配序号
             for idx, doc in enumerate(self.documents, start=1):
                 doc.index = idx
             
-            logger.info(f"文档已按 {key} {'降序' if reverse else '升序'} 排序，重新分配序号")
+            logger.info("文档已按 %s %s 排序，重新分配序号", key, "降序" if reverse else "升序")
         
         except Exception as e:
-            logger.error(f"文档排序失败: {e}", exc_info=True)
+            logger.error("文档排序失败: %s", e, exc_info=True)
     
     def get_context_for_llm(self, max_docs: int = None) -> str:
         """
@@ -169,14 +251,13 @@ class DocumentManager:
         # 限制文档数量
         docs_to_use = self.documents[:max_docs] if max_docs else self.documents
         
-        context_parts = []
-        for doc in docs_to_use:
-            # 格式：[序号] 来源：xxx\n内容：xxx
-            # 注意：这里的序号是排序后的 index，用于引用
-            part = f"[{doc.index}] 来源：{doc.source}\n内容：{doc.content}"
-            context_parts.append(part)
-        
-        return "\n\n".join(context_parts)
+        # 格式：[序号] 来源：xxx\n内容：xxx
+        # 注意：这里的序号是排序后的 index，用于引用
+        # （join 内部总会先物化为序列，列表推导式比生成器或逐个 append 都快）
+        return "\n\n".join([
+            f"[{doc.index}] 来源：{doc.source}\n内容：{doc.content}"
+            for doc in docs_to_use
+        ])
     
     def get_references(self, max_docs: int = None) -> List[Dict[str, Any]]:
         """
@@ -201,41 +282,43 @@ class DocumentManager:
         no_doc_id_items = []  # 没有 doc_id 的切片
         
         for doc in docs_to_process:
-            doc_id = doc.metadata.get("doc_id") if doc.metadata else None
+            # metadata 在构造时已归一为 dict,字段只取一次
+            metadata = doc.metadata
+            doc_id = metadata.get("doc_id")
+            current_score = metadata.get("score", 0)
             
             if doc_id:
-                # 有 doc_id,按文档分组
-                if doc_id not in doc_groups:
-                    doc_groups[doc_id] = {
+                # 有 doc_id,按文档分组(每个切片只查找一次分组)
+                group = doc_groups.get(doc_id)
+                if group is None:
+                    group = doc_groups[doc_id] = {
                         "doc_id": doc_id,
                         "source": doc.source,
-                        "max_score": doc.metadata.get("score", 0) if doc.metadata else 0,
-                        "doc_url": doc.metadata.get("doc_url") if doc.metadata else None,
-                        "knowledge_base_id": doc.metadata.get("knowledge_base_id") if doc.metadata else None,
-                        "knowledge_base_name": doc.metadata.get("knowledge_base_name") if doc.metadata else None,
+                        "max_score": current_score,
+                        "doc_url": metadata.get("doc_url"),
+                        "knowledge_base_id": metadata.get("knowledge_base_id"),
+                        "knowledge_base_name": metadata.get("knowledge_base_name"),
                         "chunks": []
                     }
-                
-                # 更新最高分数
-                current_score = doc.metadata.get("score", 0) if doc.metadata else 0
-                if current_score > doc_groups[doc_id]["max_score"]:
-                    doc_groups[doc_id]["max_score"] = current_score
+                elif current_score > group["max_score"]:
+                    # 更新最高分数
+                    group["max_score"] = current_score
                 
                 # 添加切片信息
-                doc_groups[doc_id]["chunks"].append({
+                group["chunks"].append({
                     "chunk_id": doc.knowledge_id,
                     "score": current_score,
-                    "content_preview": doc.content[:100] + "..." if len(doc.content) > 100 else doc.content
+                    "content_preview": doc.preview
                 })
             else:
                 # 没有 doc_id,单独处理
                 no_doc_id_items.append({
                     "chunk_id": doc.knowledge_id,
                     "source": doc.source,
-                    "score": doc.metadata.get("score", 0) if doc.metadata else 0,
-                    "content_preview": doc.content[:100] + "..." if len(doc.content) > 100 else doc.content,
-                    "knowledge_base_id": doc.metadata.get("knowledge_base_id") if doc.metadata else None,
-                    "knowledge_base_name": doc.metadata.get("knowledge_base_name") if doc.metadata else None
+                    "score": current_score,
+                    "content_preview": doc.preview,
+                    "knowledge_base_id": metadata.get("knowledge_base_id"),
+                    "knowledge_base_name": metadata.get("knowledge_base_name")
                 })
         
         # 将分组的文档转换为列表并按分数排序
@@ -245,23 +328,23 @@ class DocumentManager:
         # 添加没有 doc_id 的切片(也按分数排序)
         no_doc_id_items.sort(key=lambda x: x["score"], reverse=True)
         
-        # 合并结果并分配序号
-        all_references = []
+        # 分配序号
         for idx, ref in enumerate(references, start=1):
             ref["id"] = idx
             ref["title"] = ref["source"]  # 使用 source 作为标题
             ref["chunk_count"] = len(ref["chunks"])  # 该文章的切片数量
-            all_references.append(ref)
         
-        # 添加没有 doc_id 的项
-        for idx, ref in enumerate(no_doc_id_items, start=len(all_references) + 1):
+        # 没有 doc_id 的项排在后面
+        for idx, ref in enumerate(no_doc_id_items, start=len(references) + 1):
             ref["id"] = idx
             ref["title"] = ref["source"]
-            all_references.append(ref)
+        
+        # 合并结果(一次按最终长度分配,无逐个 append 的扩容)
+        all_references = references + no_doc_id_items
         
         used_docs = len(docs_to_process)
         total_docs = len(self.documents)
-        logger.info(f"生成参考文献: {len(all_references)} 篇文章 (使用 {used_docs}/{total_docs} 个切片)")
+        logger.info("生成参考文献: %d 篇文章 (使用 %d/%d 个切片)", len(all_references), used_docs, total_docs)
         
         return all_references
     
@@ -0,0 +1,128 @@
+"""
+响应缓存模块
+缓存 LLM 生成的总结、知识库检索结果等,相同请求直接复用,跳过远程调用
+"""
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional, Tuple
+
+# 归一化问题时去掉的首尾标点
+_QUERY_STRIP_CHARS = " \t\r\n?？!！。.,，;；"
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """
+    问题归一化(大小写、空白和首尾标点),仅表面形式不同的问题视为同一问题
+
+    Args:
+        query: 用户问题
+
+    Returns:
+        str: 归一化后的问题
+    """
+    return _WHITESPACE_RE.sub(" ", query.strip(_QUERY_STRIP_CHARS)).lower()
+
+
+class SummaryCache:
+    """
+    总结结果缓存(LRU + TTL)
+
+    以 (归一化问题, 有序文档ID) 为键:总结中的 [1]、[2] 等引用按文档顺序编号,
+    文档相同但顺序不同时引用会错位,因此顺序也必须一致才命中
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def key(query: str, doc_ids: Iterable) -> Tuple[str, Tuple]:
+        """
+        计算缓存键
+
+        Args:
+            query: 用户问题
+            doc_ids: 送入总结的文档ID(按引用序号顺序)
+
+        Returns:
+            Tuple: (归一化问题, 文档ID元组)
+        """
+        return normalize_query(query), tuple(doc_ids)
+
+    def get(self, query: str, doc_ids: Iterable) -> Optional[str]:
+        """
+        查询缓存(命中时刷新 LRU 顺序)
+
+        Args:
+            query: 用户问题
+            doc_ids: 本次送入总结的文档ID(按引用序号顺序)
+
+        Returns:
+            Optional[str]: 缓存的总结内容,未命中或已过期时返回 None
+        """
+        return self._entries.get(self.key(query, doc_ids))
+
+    def put(self, query: str, doc_ids: Iterable, content: str):
+        """
+        写入缓存(超过上限时淘汰最久未使用的条目)
+
+        Args:
+            query: 用户问题
+            doc_ids: 本次送入总结的文档ID(按引用序号顺序)
+            content: 完整的总结内容
+        """
+        self._entries.put(self.key(query, doc_ids), content)
+
+
+class TTLCache:
+    """
+    通用 LRU + TTL 缓存
+
+    条目超过有效期后视为未命中并删除,超过条目上限时淘汰最久未使用的条目
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # 键 -> (写入时间, 值)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        查询缓存(命中时刷新 LRU 顺序)
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            Optional[Any]: 缓存的值,未命中或已过期时返回 None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        created_at, value = entry
+        if time.monotonic() - created_at > self.ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        """
+        写入缓存(超过上限时淘汰最久未使用的条目)
+
+        Args:
+            key: 缓存键
+            value: 缓存的值
+        """
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存(数据源变更后调用)"""
+        self._entries.clear()
@@ -0,0 +1,53 @@
+"""
+异步工具模块测试
+"""
+import asyncio
+
+from shared.utils.async_utils import buffered, merged
+
+
+class _CloseOnlyStream:
+    """只提供 close() 的流(与 openai AsyncStream 一致),记录是否被关闭"""
+
+    def __init__(self):
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0.01)
+        return "token"
+
+    async def close(self):
+        self.closed = True
+
+
+def test_buffered_closes_source_on_early_exit():
+    """消费者中途退出时,源流经 close() 关闭"""
+
+    async def run():
+        stream = _CloseOnlyStream()
+        chunks = buffered(stream, maxsize=2)
+        async for _ in chunks:
+            break
+        await chunks.aclose()
+        return stream.closed
+
+    assert asyncio.run(run())
+
+
+def test_merged_closes_sources_on_early_exit():
+    """合并流提前退出时,各源流经 close() 关闭"""
+
+    async def run():
+        streams = [_CloseOnlyStream(), _CloseOnlyStream()]
+        events = merged(streams)
+        async for _ in events:
+            break
+        await events.aclose()
+        # 拉取任务被取消后,在下一轮事件循环中完成清理
+        await asyncio.sleep(0)
+        return [stream.closed for stream in streams]
+
+    assert asyncio.run(run()) == [True, True]